@@ -1,11 +1,93 @@
-from subprocess import Popen, PIPE
+import asyncio
+import base64
+import cProfile
+import json
+import math
+import re
+import socket
+import sqlite3
+import struct
+import zlib
+import numpy as np
+from subprocess import Popen
 from datetime import datetime, timedelta
-from time import sleep
-from multiprocessing.dummy import Pool
+from time import sleep, perf_counter, monotonic
+from bisect import bisect_left
+from heapq import heappush, heappop
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice, zip_longest
+from threading import Thread, Event, Lock
+from queue import Queue, Empty
+from collections import OrderedDict
+from multiprocessing import freeze_support
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+from shutil import copyfile
 from matplotlib import pyplot as plt, dates
-from os import path, system, walk
-from zipfile import ZipFile, ZIP_DEFLATED
+from os import path, system, getpid, remove, replace, makedirs, cpu_count, fsync
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 from sys import argv, exit
+from traceback import print_exc
+
+PROBE_INTERVAL = 12  # Seconds between the start of each probe of a host (10 pings plus a brief pause).
+PROBE_CONCURRENCY = 64  # Probes always allowed to run at once, raised to however many the hosts' intervals need.
+PROBER = 'icmp'  # Probe backend: 'icmp' sends echoes from within the script, 'ping' spawns the OS ping command.
+PROBE_TIMEOUT = 4  # Seconds to wait for each echo reply from the 'icmp' backend, the same as Windows ping.
+PROBE_COUNT = 10  # Pings sent one second apart in each probe of a host.
+PROBE_BUDGET = 200  # Most probes started per second across all hosts, e.g. 2400 hosts every 12 seconds.
+TARGETS_FILE = 'targets.txt'  # Target file with groups, tags and per host intervals, used instead of 'hosts.txt'.
+BACKOFF_LIMIT = 16  # Hosts which keep timing out are probed up to this many times less often.
+DEGRADED_RATIO = 1.5  # Hosts whose recent latency is this much above their usual latency count as degrading.
+DEGRADED_MINIMUM = 5  # Milliseconds latency must also rise by to count as degrading, so fast links' jitter doesn't.
+DEGRADED_SPEEDUP = 4  # Degrading hosts, or those losing pings, are probed this many times more often.
+SYSINFO_TRACES = 20  # Most hosts two() writes a traceroute of into 'sysinfo.txt'.
+
+# Samples are stored in {hostname}.dat as fixed-width 20 byte records:
+# timestamp (microseconds since epoch), host id, RTT (microseconds), status, 3 bytes padding.
+SAMPLE_EXT = '.dat'
+SAMPLE_STRUCT = struct.Struct('<qIIB3x')
+SAMPLE_DTYPE = np.dtype({'names': ['time', 'host', 'rtt', 'status'],
+                         'formats': ['<i8', '<u4', '<u4', 'u1'],
+                         'offsets': [0, 8, 12, 16], 'itemsize': SAMPLE_STRUCT.size})
+STATUS_REPLY = 0
+STATUS_TIMEOUT = 1
+REPLY_PATTERN = re.compile(r'time[=<]\s*([\d.]+)\s*ms')  # Matches the RTT in a Windows or Linux reply line.
+PLOT_DPI = 500  # Resolution of saved graphs.
+PLOT_BINS = 2000  # Captures with more samples than this are drawn as min/mean/max envelopes of this many buckets.
+PLOT_CHUNK = 1 << 20  # Number of samples binned at a time, so memory use doesn't grow with capture length.
+LIVE_WINDOW = 600  # Number of recent samples kept in memory per host for the live dashboard.
+LIVE_REFRESH = 10  # Seconds between live dashboard refreshes during a test, 0 to turn the dashboard off.
+PACKAGE_COMPRESSION = 'fast'  # Archive compression: 'fast', 'best' (smallest archive) or 'store' (none).
+CHECK_COUNT = 5  # Maximum pings sent when checking a host is responding.
+CHECK_CONCURRENCY = 500  # Maximum number of hosts checked at the same time.
+CHECK_CACHE = 60  # Seconds a host check result is reused for.
+PATH_MAX_HOPS = 30  # Furthest hop checked when discovering the path to a host.
+PATH_TIMEOUT = 3  # Seconds to wait for replies from every hop of the path.
+PATH_RECHECK = 300  # Seconds between checks for route changes during three(), 0 to turn off.
+HOP_PATTERN = re.compile(r'(?:Reply from|From|bytes from) ([0-9A-Fa-f.:]*[0-9A-Fa-f])')  # Address replying to a ping.
+WRITER_BATCH = 1 << 18  # Bytes of samples buffered before they are written to disk.
+WRITER_FLUSH = 2  # Most seconds samples are buffered before they are written to disk.
+WRITER_SYNC = 30  # Seconds between forcing written samples onto the disk and saving statistics files.
+WRITER_FILES = 256  # Most sample files kept open at once.
+STORE_FILE = 'history.db'  # SQLite database keeping the history of every capture, None to turn it off.
+STORE_RETENTION = 30  # Days of samples kept by compact_store() after each test, older ones become 1 minute summaries.
+METRICS_FILE = None  # File a snapshot of the script's own metrics is written to during tests, e.g. 'metrics.prom'.
+METRICS_INTERVAL = 15  # Seconds between metrics snapshots.
+METRICS_PORT = None  # Port on 127.0.0.1 to serve metrics on in Prometheus text format during tests, e.g. 9470.
+PROFILE_FILE = None  # File to save cProfile statistics of the whole run to, e.g. 'pingscript.prof'.
+COLLECTOR = None  # Address ('host' or 'host:port') of a collector to stream samples to, None when running alone.
+COLLECTOR_PORT = 7878  # Port the collector listens on when none is given.
+COLLECTOR_DIR = 'collector'  # Directory the collector stores samples from every agent in.
+AGENT_NAME = socket.gethostname()  # Name this PC sends to the collector with its samples.
+AGENT_BATCH = 5  # Seconds between batches of samples sent to the collector.
+AGENT_BUFFER = 1 << 20  # Most bytes of samples held per host while the collector can't be reached.
+AGENT_LINE_LIMIT = AGENT_BUFFER * 2  # Longest line read from an agent or collector, fits AGENT_BUFFER in base64.
+AGENT_TIMEOUT = 30  # Seconds to wait for the collector to accept a connection or acknowledge samples.
+STATS_EXT = '.stats'  # Sidecar file holding the HostStats state for {hostname}.dat.
+STATS_GROWTH = 1.02  # Each latency histogram bucket is 2% wider than the last, so percentiles are within ~1%.
+TIMEOUT_PATTERN = re.compile(r'request timed out|request timeout|destination host unreachable|general failure|'
+                             r'transmit failed|ttl expired|no answer yet', re.IGNORECASE)
 
 
 def page_refresh():
@@ -22,146 +104,1479 @@ def reset_session(runtime):
     menu(runtime)
 
 
+class Metrics:
+    """Counters, gauges and histograms describing what the script itself is spending time on.
+    Updated from the probe loop and the sample writer's thread, so every access holds 'lock'.
+    """
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)  # Histogram bounds (seconds).
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}  # Name -> [bucket counts, sum, count].
+        self.lock = Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        """Adds a measurement to a histogram."""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * (len(self.BUCKETS) + 1), 0, 0]
+            histogram[0][bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name):
+        """Times the body of a 'with' block into a histogram."""
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started)
+
+    def export(self):
+        """Returns every metric in Prometheus text format."""
+        with self.lock:  # Copy, so other threads aren't held up while formatting.
+            counters, gauges = dict(self.counters), dict(self.gauges)
+            histograms = {name: (list(buckets), total, count) for name, (buckets, total, count)
+                          in self.histograms.items()}
+        lines = []
+        for name, value in sorted(counters.items()):
+            lines += ['# TYPE pingscript_{} counter'.format(name), 'pingscript_{} {}'.format(name, value)]
+        for name, value in sorted(gauges.items()):
+            lines += ['# TYPE pingscript_{} gauge'.format(name), 'pingscript_{} {}'.format(name, value)]
+        for name, (buckets, total, count) in sorted(histograms.items()):
+            lines.append('# TYPE pingscript_{} histogram'.format(name))
+            cumulative = 0
+            for bound, bucket in zip(self.BUCKETS + ('+Inf',), buckets):
+                cumulative += bucket
+                lines.append('pingscript_{}_bucket{{le="{}"}} {}'.format(name, bound, cumulative))
+            lines += ['pingscript_{}_sum {}'.format(name, total), 'pingscript_{}_count {}'.format(name, count)]
+        return '\n'.join(lines) + '\n'
+
+    def save(self, filename):
+        """Writes a snapshot of every metric to 'filename', replacing the previous one in a single step."""
+        with open(filename + '.tmp', 'w') as file:
+            file.write(self.export())
+        replace(filename + '.tmp', filename)
+
+
+metrics = Metrics()
+
+
+async def serve_metrics(reader, writer):
+    """Answers any HTTP request with the current metrics."""
+    try:
+        await reader.readuntil(b'\r\n\r\n')  # Wait for the end of the request headers.
+        body = metrics.export().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+async def export_metrics(stop, server=None):
+    """Saves metrics to METRICS_FILE every METRICS_INTERVAL seconds until 'stop', then closes the metrics 'server'."""
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), METRICS_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        if METRICS_FILE is not None:
+            try:
+                metrics.save(METRICS_FILE)
+            except OSError as error:  # Don't stop the test, the next snapshot may succeed.
+                print('Metrics could not be saved to {}: {}'.format(METRICS_FILE, error))
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+
+
+def checksum(data):
+    """Calculates the internet checksum of an ICMP packet."""
+    if len(data) % 2:  # Pad odd length packets with a zero byte.
+        data += b'\x00'
+    total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)  # Fold carry bits back into the sum.
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class IcmpProber:
+    """Sends and receives ICMP echoes for any number of hosts over a single socket.
+    Raises OSError when no ICMP socket can be opened (e.g. not running as administrator).
+    """
+    def __init__(self):
+        try:  # Raw sockets need administrator/root privileges.
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.raw = True
+        except PermissionError:  # Linux allows unprivileged ICMP through datagram sockets.
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.raw = False
+        self.sock.bind(('', 0))  # Windows won't receive on a raw socket until it is bound.
+        self.ttl = self.sock.getsockopt(socket.IPPROTO_IP, socket.IP_TTL)  # OS default, 128 on Windows.
+        self.ident = getpid() & 0xFFFF  # Identifies replies to this process on raw sockets.
+        self.seq = 0
+        self.pending = {}  # Sequence number -> (send time, callback, TTL) for echoes awaiting a reply.
+        self.lock = Lock()
+        self.closed = False
+        Thread(target=self._receive, daemon=True).start()
+
+    def _send(self, address, callback, ttl=None):
+        """Sends one echo request to 'address'. 'callback' is called with the RTT (ms) and the replying address.
+        If 'ttl' is given, the echo is limited to that many hops and 'TTL expired' replies also count.
+        """
+        with self.lock:
+            self.seq = (self.seq + 1) & 0xFFFF
+            seq = self.seq
+            payload = b'PingScript'.ljust(32, b'.')  # 32 bytes of data, same as Windows ping.
+            header = struct.pack('!BBHHH', 8, 0, 0, self.ident, seq)
+            header = struct.pack('!BBHHH', 8, 0, checksum(header + payload), self.ident, seq)
+            self.pending[seq] = (perf_counter(), callback, ttl)
+            if ttl is not None:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+            self.sock.sendto(header + payload, (address, 0))
+            if ttl is not None:  # Restore the default for normal echoes.
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, self.ttl)
+        return seq
+
+    def _cancel(self, seq):
+        """Forgets an echo request which has timed out."""
+        with self.lock:
+            self.pending.pop(seq, None)
+
+    def _receive(self):
+        """Background thread which matches every reply on the socket to its echo request."""
+        while True:
+            try:
+                data, (responder, _) = self.sock.recvfrom(2048)
+            except OSError:
+                if self.closed:
+                    break
+                metrics.count('receive_errors_total')  # E.g. Windows reporting an ICMP error, keep receiving.
+                sleep(0.01)
+                continue
+            received = perf_counter()
+            if self.raw:  # Raw sockets include the IP header, skip over it.
+                data = data[(data[0] & 0x0F) * 4:]
+            if len(data) < 8:
+                continue
+            icmp_type, _, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+            expired = icmp_type == 11 and self.raw and len(data) >= 36
+            if expired:  # 'TTL expired' carries the start of our echo request after its own IP header.
+                inner = data[8 + (data[8] & 0x0F) * 4:]
+                if len(inner) < 8:
+                    continue
+                icmp_type, _, _, ident, seq = struct.unpack('!BBHHH', inner[:8])
+                if icmp_type != 8:
+                    continue
+            elif icmp_type != 0:  # Not an echo reply.
+                continue
+            if self.raw and ident != self.ident:  # Reply belongs to another process.
+                continue
+            with self.lock:
+                sent = self.pending.get(seq)
+                if sent is None or (expired and sent[2] is None):  # Only TTL limited echoes expect 'TTL expired'.
+                    continue
+                del self.pending[seq]
+            try:
+                sent[1]((received - sent[0]) * 1000, responder)
+            except Exception:  # Don't let one caller's error stop replies reaching every other echo.
+                metrics.count('receive_errors_total')
+                print_exc()
+
+    def ping(self, hostname, count=10, interval=1, timeout=PROBE_TIMEOUT):
+        """Pings 'hostname' 'count' times. Returns its address and a list of RTTs (ms), None for timeouts."""
+        address = socket.gethostbyname(hostname)
+        rtts = []
+        for n in range(count):
+            started = perf_counter()
+            replied, result = Event(), []
+            seq = self._send(address, lambda rtt, _: (result.append(rtt), replied.set()))
+            if not replied.wait(timeout):
+                self._cancel(seq)
+            rtts.append(result[0] if result else None)
+            if n < count - 1:  # Wait out the rest of the interval before the next echo.
+                sleep(max(0, interval - (perf_counter() - started)))
+        return address, rtts
+
+    async def ping_async(self, hostname, count=10, interval=1, timeout=PROBE_TIMEOUT):
+        """Coroutine version of ping() for use in the probe engine."""
+        loop = asyncio.get_running_loop()
+        address = (await loop.getaddrinfo(hostname, None, family=socket.AF_INET))[0][4][0]
+        rtts = []
+        for n in range(count):
+            started = loop.time()
+            reply = loop.create_future()
+            seq = self._send(address, lambda rtt, _: loop.call_soon_threadsafe(
+                lambda: reply.done() or reply.set_result(rtt)))
+            try:
+                rtts.append(await asyncio.wait_for(reply, timeout))
+            except asyncio.TimeoutError:
+                self._cancel(seq)
+                rtts.append(None)
+            if n < count - 1:  # Wait out the rest of the interval before the next echo.
+                await asyncio.sleep(max(0, interval - (loop.time() - started)))
+        return address, rtts
+
+    async def trace_async(self, address, max_hops, timeout):
+        """Sends echoes with every TTL from 1 to 'max_hops' at once. Returns the address which replied at each hop.
+        Only raw sockets receive 'TTL expired' replies.
+        """
+        loop = asyncio.get_running_loop()
+        sent = []
+        for ttl in range(1, max_hops + 1):
+            reply = loop.create_future()
+            seq = self._send(address, lambda rtt, responder, reply=reply: loop.call_soon_threadsafe(
+                lambda: reply.done() or reply.set_result(responder)), ttl)
+            sent.append((seq, reply))
+        await asyncio.wait([reply for _, reply in sent], timeout=timeout)
+        hops = []
+        for seq, reply in sent:
+            if not reply.done():
+                self._cancel(seq)
+            hops.append(reply.result() if reply.done() else None)
+        return hops
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+
+prober = None  # Shared IcmpProber, created on first use by get_prober().
+
+
+def get_prober():
+    """Returns the shared IcmpProber, or None if the 'ping' backend is in use or no ICMP socket is available."""
+    global prober, PROBER
+    if PROBER == 'icmp' and prober is None:
+        try:
+            prober = IcmpProber()
+        except OSError:  # Fall back to spawning the OS ping command.
+            PROBER = 'ping'
+    return prober if PROBER == 'icmp' else None
+
+
+async def reachable(hostname):
+    """Sends up to CHECK_COUNT pings to 'hostname', returning True as soon as one is answered."""
+    icmp = get_prober()
+    if icmp is not None:  # Send pings from within the script, one at a time.
+        for _ in range(CHECK_COUNT):
+            try:
+                _, rtts = await icmp.ping_async(hostname, 1)
+            except OSError:  # Hostname could not be resolved.
+                return False
+            if rtts[0] is not None:
+                return True
+        return False
+    # Spawn the OS ping command, stopping it at the first reply.
+    ping = await asyncio.create_subprocess_exec('ping', '-n', str(CHECK_COUNT), hostname,
+                                                stdout=asyncio.subprocess.PIPE)
+    try:
+        async for line in ping.stdout:
+            if REPLY_PATTERN.search(line.decode(errors='replace')) is not None:  # Ping was successful.
+                return True
+        return False
+    finally:
+        if ping.returncode is None:
+            ping.kill()
+        await ping.wait()
+
+
+async def check_hosts_async(hosts):
+    """Checks every host at the same time. Returns the responsive hosts, in order and without duplicates.
+    Results are cached for CHECK_CACHE seconds.
+    """
+    hosts = [host for host in dict.fromkeys(hosts) if host != '']  # Remove duplicates and blank lines.
+    limiter = asyncio.Semaphore(CHECK_CONCURRENCY)
+
+    async def check(hostname):
+        cached = check_cache.get(hostname)
+        if cached is not None and monotonic() - cached[0] < CHECK_CACHE:
+            return cached[1]
+        async with limiter:
+            result = await reachable(hostname)
+        check_cache[hostname] = (monotonic(), result)
+        return result
+
+    checked = await asyncio.gather(*[check(host) for host in hosts])
+    for hostname, result in zip(hosts, checked):
+        if not result:  # No positive responses in the test. Host is not responding.
+            print('"{}" is not responding.'.format(hostname))
+    return [hostname for hostname, result in zip(hosts, checked) if result]
+
+
+check_cache = {}  # Hostname -> (time checked, result) for check_hosts_async().
+
+
+def check_hosts(hosts):
+    """Ensures that hosts are responding to pings before performing a test. Returns the responsive hosts."""
+    return asyncio.run(check_hosts_async(hosts))
+
+
 def host_check(hostname):
     """Ensures that a host is responding to pings before performing a test."""
-    check = Popen(['ping', '-n', '5', hostname], stdout=PIPE)  # Send 5 ICMP packets.
-    checked = []
-    for line in check.stdout:  # Save output of pings to list(checked)
-        line = str(line).split()
-        if len(line) > 4 and str(line[4])[:4] == 'time':  # If this appears in string, ping was successful.
-            checked.append(line[4])  # Add to list for counting.
-    if len(checked) > 0:  # At least 1 positive response saved in list(checked).
+    if len(check_hosts([hostname])) > 0:
         return hostname  # Return hostname to append to list(hosts)
-    else:  # No positive responses in the test. Host is not responding.
-        print('"{}" is not responding.'.format(hostname))
 
 
-def test(hostname):
-    """Performs main testing loop."""
-    filename = hostname + '.log'
+def host_id(hostname):
+    """Returns the id stored in sample records for 'hostname'."""
+    return zlib.crc32(hostname.encode())
+
+
+def pack_samples(hostname, samples):
+    """Packs an iterable of (datetime, RTT in ms or None for timeout) into .dat records."""
+    ident = host_id(hostname)
+    records = bytearray()
+    for when, rtt in samples:
+        if rtt is None:
+            records += SAMPLE_STRUCT.pack(int(when.timestamp() * 1e6), ident, 0, STATUS_TIMEOUT)
+        else:
+            records += SAMPLE_STRUCT.pack(int(when.timestamp() * 1e6), ident, round(rtt * 1000), STATUS_REPLY)
+    return bytes(records)
+
+
+def open_samples(hostname):
+    """Opens {hostname}.dat for appending, first cutting off any part-written record left by a crash."""
+    file = open(hostname + SAMPLE_EXT, 'ab')
+    torn = file.tell() % SAMPLE_STRUCT.size
+    if torn:
+        file.truncate(file.tell() - torn)
+    return file
+
+
+def write_samples(hostname, samples, mode='ab'):
+    """Appends samples to {hostname}.dat. 'samples' is an iterable of (datetime, RTT in ms or None for timeout)."""
+    samples = iter(samples)
+    with open_samples(hostname) if mode == 'ab' else open(hostname + SAMPLE_EXT, mode) as file:
+        while True:  # Pack records in chunks so long iterables aren't held in memory.
+            records = pack_samples(hostname, islice(samples, 65536))
+            if len(records) == 0:
+                break
+            file.write(records)
+
+
+def record_samples(hostname, samples):
+    """Saves samples from the probe loop to {hostname}.dat and updates the host's running statistics."""
+    records = pack_samples(hostname, samples)
+    if COLLECTOR is not None:  # Queue the samples for the next batch sent to the collector.
+        batch = agent_batches.setdefault(hostname, bytearray())
+        batch += records
+        if len(batch) > AGENT_BUFFER:  # Collector has been unreachable for a while, drop the oldest samples.
+            del batch[:len(batch) - AGENT_BUFFER // SAMPLE_STRUCT.size * SAMPLE_STRUCT.size]
+    store_records(hostname, records)
+
+
+def store_records(hostname, records, series=None):
+    """Adds packed records to the host's live window and queues them for the sample writer, which appends them
+    to {hostname}.dat, the history store under 'series' (default the hostname) and the host's running statistics.
+    """
+    if hostname not in live_windows:
+        live_windows[hostname] = LiveWindow()
+    live_windows[hostname].add(np.frombuffer(records, dtype=SAMPLE_DTYPE))
+    get_writer().write(hostname, records, series or hostname)
+
+
+def read_samples(hostname):
+    """Maps {hostname}.dat into memory as a NumPy array of SAMPLE_DTYPE records."""
+    filename = hostname + SAMPLE_EXT
+    if path.getsize(filename) < SAMPLE_DTYPE.itemsize:  # Empty files can't be memory mapped.
+        return np.zeros(0, dtype=SAMPLE_DTYPE)
+    return np.memmap(filename, dtype=SAMPLE_DTYPE, mode='r', shape=(path.getsize(filename) // SAMPLE_DTYPE.itemsize,))
+
+
+def sample_times(samples):
+    """Converts sample timestamps to local time datetime64 values for plotting."""
+    offset = datetime.now().astimezone().utcoffset() // timedelta(microseconds=1)
+    return (samples['time'] + offset).astype('datetime64[us]')
+
+
+class HostStats:
+    """Running latency statistics for one host, updated incrementally as samples arrive.
+    Percentiles come from a histogram of logarithmic buckets, so memory and query time don't grow with samples.
+    """
+    def __init__(self, state=None):
+        state = state or {}
+        self.offset = state.get('offset', 0)  # Number of .dat records already counted.
+        self.replies = state.get('replies', 0)
+        self.timeouts = state.get('timeouts', 0)
+        self.rtt_min = state.get('rtt_min')  # Latencies are kept in microseconds.
+        self.rtt_max = state.get('rtt_max')
+        self.rtt_sum = state.get('rtt_sum', 0)
+        self.jitter_sum = state.get('jitter_sum', 0)  # Sum of differences between consecutive replies.
+        self.last_rtt = state.get('last_rtt')
+        self.buckets = {int(k): v for k, v in state.get('buckets', {}).items()}
+
+    def update(self, samples):
+        """Adds an array of SAMPLE_DTYPE records to the statistics."""
+        self.offset += len(samples)
+        rtts = samples['rtt'][samples['status'] == STATUS_REPLY].astype(np.int64)
+        self.timeouts += len(samples) - len(rtts)
+        if len(rtts) == 0:
+            return
+        self.replies += len(rtts)
+        self.rtt_min = int(rtts.min()) if self.rtt_min is None else min(self.rtt_min, int(rtts.min()))
+        self.rtt_max = int(rtts.max()) if self.rtt_max is None else max(self.rtt_max, int(rtts.max()))
+        self.rtt_sum += int(rtts.sum())
+        buckets, counts = np.unique((np.log(np.maximum(rtts, 1)) / math.log(STATS_GROWTH)).astype(np.int64),
+                                    return_counts=True)
+        for bucket, count in zip(buckets.tolist(), counts.tolist()):
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        if self.last_rtt is not None:  # Jitter carries on from the last reply of the previous update.
+            rtts = np.concatenate(([self.last_rtt], rtts))
+        self.jitter_sum += int(np.abs(np.diff(rtts)).sum())
+        self.last_rtt = int(rtts[-1])
+
+    def percentile(self, percent):
+        """Returns the approximate latency (ms) below which 'percent' of replies fall."""
+        if self.replies == 0:
+            return 0
+        target = self.replies * percent / 100
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(max(STATS_GROWTH ** (bucket + 0.5), self.rtt_min), self.rtt_max) / 1000
+        return self.rtt_max / 1000
+
+    def summary(self):
+        """Returns the current statistics in milliseconds (loss in percent)."""
+        total = self.replies + self.timeouts
+        return {'min': (self.rtt_min or 0) / 1000,
+                'max': (self.rtt_max or 0) / 1000,
+                'avg': self.rtt_sum / self.replies / 1000 if self.replies else 0,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'jitter': self.jitter_sum / (self.replies - 1) / 1000 if self.replies > 1 else 0,
+                'loss': self.timeouts / total * 100 if total else 0}
+
+    def save(self, hostname):
+        """Writes the statistics to the {hostname}.stats sidecar file, replacing the previous one in a single step."""
+        filename = hostname + STATS_EXT
+        with open(filename + '.tmp', 'w') as file:
+            json.dump(self.__dict__, file)
+        replace(filename + '.tmp', filename)
+
+
+host_stats = {}  # Hostname -> HostStats for hosts probed during this run.
+stats_lock = Lock()  # Held while the sample writer updates or saves host_stats.
+
+
+def update_stats(hostname):
+    """Loads {hostname}.stats and adds any samples written to {hostname}.dat since it was last saved."""
+    state = None
+    if path.exists(hostname + STATS_EXT):
+        try:
+            with open(hostname + STATS_EXT, 'r') as file:
+                state = json.load(file)
+        except ValueError:  # Unreadable, e.g. left part written by an older version. Count every sample again.
+            state = None
+    stats = HostStats(state)
+    samples = read_samples(hostname)
+    if stats.offset > len(samples):  # .dat file has been replaced, start again.
+        stats = HostStats()
+    if stats.offset < len(samples):
+        stats.update(samples[stats.offset:])
+        stats.save(hostname)
+    return stats
+
+
+class HistoryStore:
+    """SQLite history of samples from every capture, indexed by host and time.
+    Samples older than the retention period are compacted into 1 minute summaries.
+    Times are given and returned as microseconds since epoch, latencies in microseconds.
+    """
+    def __init__(self, filename=STORE_FILE):
+        self.db = sqlite3.connect(filename, check_same_thread=False)  # Written by the sample writer's thread.
+        self.db.execute('PRAGMA auto_vacuum=INCREMENTAL')  # Only takes effect for new databases.
+        self.db.execute('PRAGMA journal_mode=WAL')  # Readers don't block the probe loop writing.
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS hosts (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+            CREATE TABLE IF NOT EXISTS samples (host INTEGER, time INTEGER, rtt INTEGER, status INTEGER,
+                                                PRIMARY KEY (host, time)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS minutes (host INTEGER, minute INTEGER, replies INTEGER, timeouts INTEGER,
+                                                rtt_sum INTEGER, rtt_min INTEGER, rtt_max INTEGER,
+                                                PRIMARY KEY (host, minute)) WITHOUT ROWID;
+        """)
+        self.hosts = dict(self.db.execute('SELECT name, id FROM hosts'))
+
+    def host(self, hostname):
+        """Returns the id of 'hostname', adding it if it's new."""
+        if hostname not in self.hosts:
+            self.hosts[hostname] = self.db.execute('INSERT INTO hosts (name) VALUES (?)', (hostname,)).lastrowid
+        return self.hosts[hostname]
+
+    def append(self, hostname, records):
+        """Adds an array of SAMPLE_DTYPE records for 'hostname'."""
+        self.append_all([(hostname, records)])
+
+    def append_all(self, batches):
+        """Adds a list of (hostname, array of SAMPLE_DTYPE records) in a single transaction."""
+        with self.db:
+            for hostname, records in batches:
+                ident = self.host(hostname)
+                self.db.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)',
+                                    zip([ident] * len(records), records['time'].tolist(), records['rtt'].tolist(),
+                                        records['status'].tolist()))
+
+    def query(self, hostname, start, end):
+        """Returns every sample of 'hostname' from 'start' up to 'end' as an array of SAMPLE_DTYPE records."""
+        rows = self.db.execute('SELECT time, host, rtt, status FROM samples WHERE host = ? AND time >= ? AND time < ?'
+                               ' ORDER BY time', (self.hosts.get(hostname), start, end)).fetchall()
+        samples = np.zeros(len(rows), dtype=SAMPLE_DTYPE)
+        if len(rows) > 0:
+            samples['time'], _, samples['rtt'], samples['status'] = zip(*rows)
+            samples['host'] = host_id(hostname)
+        return samples
+
+    def downsample(self, hostname, start, end, buckets=1):
+        """Splits 'start' up to 'end' into equal time buckets, combining samples with 1 minute summaries.
+        Returns a list of (bucket start, replies, timeouts, min, avg, max latency) for buckets with samples.
+        """
+        rows = self.db.execute("""
+            SELECT (time - :start) * :buckets / (:end - :start) AS bucket, SUM(replies), SUM(timeouts),
+                   MIN(rtt_min), SUM(rtt_sum), MAX(rtt_max)
+            FROM (SELECT time, status = 0 AS replies, status != 0 AS timeouts,
+                         CASE WHEN status = 0 THEN rtt END AS rtt_min, CASE WHEN status = 0 THEN rtt ELSE 0 END
+                         AS rtt_sum, CASE WHEN status = 0 THEN rtt END AS rtt_max
+                  FROM samples WHERE host = :host AND time >= :start AND time < :end
+                  UNION ALL
+                  SELECT minute * 60000000, replies, timeouts, rtt_min, rtt_sum, rtt_max
+                  FROM minutes WHERE host = :host AND minute * 60000000 >= :start AND minute * 60000000 < :end)
+            GROUP BY bucket ORDER BY bucket""", {'host': self.hosts.get(hostname), 'start': start, 'end': end,
+                                                 'buckets': buckets}).fetchall()
+        return [(start + bucket * (end - start) // buckets, replies, timeouts, rtt_min,
+                 rtt_sum / replies if replies else None, rtt_max)
+                for bucket, replies, timeouts, rtt_min, rtt_sum, rtt_max in rows]
+
+    def summary(self, hostname, start, end):
+        """Returns min, avg and max latency (ms) and loss (%) of 'hostname' from 'start' up to 'end'."""
+        rows = self.downsample(hostname, start, end)
+        if len(rows) == 0:
+            return None
+        _, replies, timeouts, rtt_min, rtt_avg, rtt_max = rows[0]
+        return {'samples': replies + timeouts,
+                'min': (rtt_min or 0) / 1000, 'avg': (rtt_avg or 0) / 1000, 'max': (rtt_max or 0) / 1000,
+                'loss': timeouts / (replies + timeouts) * 100}
+
+    def compact(self, days=STORE_RETENTION):
+        """Replaces samples older than 'days' with 1 minute summaries, then returns the space they used to the disk.
+        Without incremental vacuuming (databases made by older versions), the space is reused for new samples.
+        """
+        cutoff = int((datetime.now() - timedelta(days=days)).timestamp()) // 60 * 60000000  # Whole minutes only.
+        with self.db:
+            if self.db.execute('SELECT 1 FROM samples WHERE time < ? LIMIT 1', (cutoff,)).fetchone() is None:
+                return  # Nothing to compact.
+            self.db.execute("""
+                INSERT INTO minutes
+                SELECT host, time / 60000000, SUM(status = 0), SUM(status != 0),
+                       SUM(CASE WHEN status = 0 THEN rtt ELSE 0 END), MIN(CASE WHEN status = 0 THEN rtt END),
+                       MAX(CASE WHEN status = 0 THEN rtt END)
+                FROM samples WHERE time < ? GROUP BY host, time / 60000000
+                ON CONFLICT (host, minute) DO UPDATE SET
+                    replies = replies + excluded.replies, timeouts = timeouts + excluded.timeouts,
+                    rtt_sum = rtt_sum + excluded.rtt_sum, rtt_min = MIN(rtt_min, excluded.rtt_min),
+                    rtt_max = MAX(rtt_max, excluded.rtt_max)""", (cutoff,))
+            self.db.execute('DELETE FROM samples WHERE time < ?', (cutoff,))
+        self.db.executescript('PRAGMA incremental_vacuum;')  # execute() would only free a single page.
+
+    def import_samples(self, hostname):
+        """Adds every sample in {hostname}.dat, e.g. from a capture made before the store existed."""
+        samples = read_samples(hostname)
+        for n in range(0, len(samples), PLOT_CHUNK):
+            self.append(hostname, samples[n:n + PLOT_CHUNK])
+
+
+store = None  # Shared HistoryStore, opened on first use by get_store().
+
+
+def get_store():
+    """Returns the shared HistoryStore, or None if STORE_FILE is None."""
+    global store
+    if store is None and STORE_FILE is not None:
+        store = HistoryStore(STORE_FILE)
+    return store
+
+
+def compact_store():
+    """Compacts samples older than STORE_RETENTION days in the history store, if it is in use."""
+    if get_store() is not None:
+        with metrics.timer('store_compact_seconds'):
+            store.compact()
+
+
+def import_store(filenames):
+    """Adds the samples in existing .dat files to the history store, then compacts it."""
+    if get_store() is None:
+        print('The history store is turned off (STORE_FILE is None).')
+        return
+    for filename in filenames:
+        if not filename.endswith(SAMPLE_EXT) or not path.exists(filename):
+            print('"{}" is not a {} file in the current directory.'.format(filename, SAMPLE_EXT))
+            continue
+        store.import_samples(filename[:-len(SAMPLE_EXT)])
+        print('Imported {}.'.format(filename))
+    compact_store()
+
+
+def print_history(hostname, start, end):
+    """Prints latency and loss of 'hostname' between two datetimes from the history store."""
+    if get_store() is None:
+        print('The history store is turned off (STORE_FILE is None).')
+        return
+    history = store.summary(hostname, int(start.timestamp() * 1e6), int(end.timestamp() * 1e6))
+    if history is None:
+        print('No samples of {} were stored between those times.'.format(hostname))
+    else:
+        print('{} from {} to {}:'.format(hostname, start.strftime("%H:%M, %d/%m/%Y"), end.strftime("%H:%M, %d/%m/%Y")))
+        print('Samples = {samples}\nMin = {min:.3f}ms\nMax = {max:.3f}ms\nAvg = {avg:.3f}ms\nLoss = {loss:.2f}%'
+              .format(**history))
+
+
+class SampleWriter:
+    """Background thread which writes samples from every prober to disk in batches.
+    Sample files are kept open, and written when WRITER_BATCH bytes are waiting or every WRITER_FLUSH seconds.
+    Every WRITER_SYNC seconds files are forced onto the disk, then statistics files are saved to match them.
+    """
+    def __init__(self):
+        self.queue = Queue()
+        self.files = OrderedDict()  # Hostname -> open sample file, least recently used first.
+        self.unsaved = set()  # Hosts with statistics newer than their .stats file.
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, hostname, records, series):
+        """Queues packed records to be written for 'hostname'. Raises RuntimeError if the thread has stopped."""
+        self._check()
+        self.queue.put((hostname, records, series))
+
+    def close(self):
+        """Writes everything still waiting, syncs it to disk and stops the thread."""
+        self._check()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _check(self):
+        if not self.thread.is_alive():
+            raise RuntimeError('The sample writer has stopped, samples can no longer be saved.')
+
+    def _run(self):
+        pending = {}  # Hostname -> (series, list of packed records) waiting to be written.
+        waiting = 0  # Bytes in 'pending'.
+        flushed = synced = monotonic()
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0, WRITER_FLUSH - (monotonic() - flushed)))
+            except Empty:
+                item = False
+            if item is None:  # Closing.
+                break
+            if item:
+                hostname, records, series = item
+                pending.setdefault(hostname, (series, []))[1].append(records)
+                waiting += len(records)
+            if waiting >= WRITER_BATCH or monotonic() - flushed >= WRITER_FLUSH:
+                metrics.gauge('writer_queue_depth', self.queue.qsize())
+                self._flush(pending)
+                pending, waiting, flushed = {}, 0, monotonic()
+                if flushed - synced >= WRITER_SYNC:
+                    self._sync()
+                    synced = monotonic()
+        self._flush(pending)
+        self._sync()
+        for file in self.files.values():
+            file.close()
+        self.files.clear()
+
+    def _flush(self, pending):
+        """Writes waiting records to each host's sample file and the history store, and updates statistics."""
+        if len(pending) == 0:
+            return
+        batches = []
+        with metrics.timer('sample_write_seconds'):
+            for hostname, (series, chunks) in pending.items():
+                try:
+                    batches.append((series, self._write(hostname, b''.join(chunks))))
+                except Exception:  # E.g. disk full. Report it and carry on with other hosts.
+                    metrics.count('writer_errors_total')
+                    print_exc()
+                    file = self.files.pop(hostname, None)
+                    if file is not None:  # Reopening cuts off any part-written record.
+                        file.close()
+        if get_store() is not None:
+            try:
+                with metrics.timer('store_write_seconds'):
+                    store.append_all(batches)
+            except (sqlite3.Error, OSError):
+                metrics.count('writer_errors_total')
+                print_exc()
+
+    def _write(self, hostname, records):
+        """Appends packed records to the host's sample file and statistics. Returns them as SAMPLE_DTYPE records."""
+        file = self.files.pop(hostname, None)
+        if file is None:
+            if len(self.files) >= WRITER_FILES:  # Close the least recently used file.
+                _, oldest = self.files.popitem(last=False)
+                oldest.flush()
+                fsync(oldest.fileno())  # Its statistics may be saved at the next sync.
+                oldest.close()
+            file = open_samples(hostname)
+        self.files[hostname] = file  # Now the most recently used.
+        file.write(records)
+        file.flush()
+        records = np.frombuffer(records, dtype=SAMPLE_DTYPE)
+        with stats_lock:
+            stats = host_stats.get(hostname)
+            if stats is None:  # First samples this run, catch up on the file including these records.
+                host_stats[hostname] = update_stats(hostname)
+            else:
+                stats.update(records)
+        self.unsaved.add(hostname)
+        return records
+
+    def _sync(self):
+        """Forces written samples onto the disk, then saves statistics files which can't now be ahead of them."""
+        with metrics.timer('sync_seconds'):
+            try:
+                for file in self.files.values():
+                    fsync(file.fileno())
+                with stats_lock:
+                    for hostname in self.unsaved:
+                        if hostname in host_stats:
+                            host_stats[hostname].save(hostname)
+                self.unsaved.clear()
+            except OSError:  # Try again at the next sync.
+                metrics.count('writer_errors_total')
+                print_exc()
+
+
+writer = None  # Shared SampleWriter, started on first use by get_writer().
+
+
+def get_writer():
+    """Returns the shared SampleWriter, starting it if needed."""
+    global writer
+    if writer is None:
+        writer = SampleWriter()
+    return writer
+
+
+def close_writer():
+    """Stops the shared SampleWriter once everything it was given is on disk."""
+    global writer
+    if writer is not None:
+        try:
+            writer.close()
+        finally:
+            writer = None
+
+
+class LiveWindow:
+    """Ring buffer of the most recent samples for one host, held in a preallocated array."""
+    def __init__(self, size=LIVE_WINDOW):
+        self.samples = np.zeros(size, dtype=SAMPLE_DTYPE)
+        self.next = 0  # Position the next sample will be written to.
+        self.count = 0  # Number of slots filled so far.
+
+    def add(self, records):
+        """Adds an array of SAMPLE_DTYPE records, overwriting the oldest samples once full."""
+        size = len(self.samples)
+        records = records[-size:]  # Anything older would be overwritten straight away.
+        first = min(len(records), size - self.next)  # Records which fit before wrapping around.
+        self.samples[self.next:self.next + first] = records[:first]
+        self.samples[:len(records) - first] = records[first:]
+        self.next = (self.next + len(records)) % size
+        self.count = min(self.count + len(records), size)
+
+    def summary(self):
+        """Returns last, min, avg and max latency (ms) and loss (%) over the window."""
+        if self.count == 0:
+            return None
+        window = self.samples[:self.count]
+        success = window['status'] == STATUS_REPLY
+        rtts = window['rtt'][success] / 1000
+        last = self.samples[self.next - 1]
+        return {'last': last['rtt'] / 1000 if last['status'] == STATUS_REPLY else None,
+                'min': rtts.min() if len(rtts) else 0,
+                'avg': rtts.mean() if len(rtts) else 0,
+                'max': rtts.max() if len(rtts) else 0,
+                'loss': (~success).sum() / self.count * 100}
+
+
+live_windows = {}  # Hostname -> LiveWindow for hosts probed during this run.
+
+
+def print_dashboard(future):
+    """Redraws the terminal with a table of each host's recent latency and loss."""
+    page_refresh()
+    print('Running tests until {}. Showing the last {} pings of each host.\n'
+          .format(future.strftime("%H:%M, %d/%m"), LIVE_WINDOW))
+    print('{:<40}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('Host', 'Last', 'Min', 'Avg', 'Max', 'Loss'))
+    for hostname, window in list(live_windows.items()):
+        live = window.summary()
+        if live is None:
+            continue
+        last = 'timeout' if live['last'] is None else '{:.1f}ms'.format(live['last'])
+        print('{:<40}{:>10}{:>8.1f}ms{:>8.1f}ms{:>8.1f}ms{:>9.1f}%'
+              .format(hostname[:39], last, live['min'], live['avg'], live['max'], live['loss']))
+
+
+async def dashboard(future, refresh):
+    """Refreshes the live dashboard every 'refresh' seconds until 'future' is reached."""
+    while datetime.now() < future:
+        await asyncio.sleep(refresh)
+        print_dashboard(future)
+
+
+async def test(hostname, count=PROBE_COUNT):
+    """Performs a single probe of a host, appending the results to {hostname}.dat. Returns the RTTs (ms)."""
     now = datetime.now()  # Save time for timestamp.
-    with open(filename, 'a+') as file:
-        file.write('\n' + now.strftime("%H:%M:%S, %d/%m/%Y") + '\n')  # Write timestamp to file.
-    with open(filename, 'a') as file:
-        Popen(['ping', '-n', '10', hostname], stdout=file).wait()  # Write result of pings to file.
-    sleep(2)  # Brief pause before restarting loop.
-
-
-def graph(hostname):
-    """Plots latency over time by reading {hostname}.log file."""
-    filename = hostname + '.log'
-    with open(filename, 'r') as f:  # Empty arrays to store data points.
-        x = []  # Datetimes for latency.
-        xt = []  # Datetimes for timeouts.
-        y = []  # Latency.
-        yt = []  # Timeouts.
-        f.readline()  # Skips first line.
-        while True:  # Collecting ping statistics.
+    icmp = get_prober()
+    if icmp is not None:  # Send pings from within the script.
+        try:
+            _, rtts = await icmp.ping_async(hostname, count)
+        except OSError:  # Hostname could not be resolved this round.
+            rtts = [None] * count
+    else:  # Spawn the OS ping command and read the results from its output.
+        with metrics.timer('ping_spawn_seconds'):
+            ping = await asyncio.create_subprocess_exec('ping', '-n', str(count), hostname,
+                                                        stdout=asyncio.subprocess.PIPE)
+        output, _ = await ping.communicate()
+        with metrics.timer('ping_parse_seconds'):
+            lines = output.decode(errors='replace').splitlines()
+            rtts = [rtt for _, rtt in parse_log(lines, now)]
+        metrics.count('parsed_lines_total', len(lines))
+    metrics.count('probes_total')
+    metrics.count('echoes_total', len(rtts))
+    metrics.count('timeouts_total', rtts.count(None))
+    # Pings are sent one second apart, starting from the timestamp.
+    record_samples(hostname, [(now + timedelta(seconds=n), rtt) for n, rtt in enumerate(rtts)])
+    return rtts
+
+
+class Target:
+    """A host to probe, with its group, tags and usual interval, and the state used to adapt its interval."""
+    def __init__(self, hostname, group='default', interval=PROBE_INTERVAL, count=PROBE_COUNT, tags=()):
+        self.hostname = hostname
+        self.group = group
+        self.base_interval = interval  # Seconds between the start of each probe while the host is healthy.
+        self.interval = interval  # Current seconds between probes, after adapting.
+        self.count = count
+        self.tags = tuple(tags)
+        self.failures = 0  # Probes in a row with no replies.
+        self.usual = None  # Slow moving average of median latency.
+        self.recent = None  # Fast moving average of median latency.
+
+    def adapt(self, rtts):
+        """Adjusts the interval after a probe: backing off while the host is down, probing faster while degrading."""
+        replies = sorted(rtt for rtt in rtts if rtt is not None)
+        if len(replies) == 0:  # Nothing answered, back off.
+            self.failures += 1
+            self.interval = self.base_interval * min(2 ** self.failures, BACKOFF_LIMIT)
+            return
+        self.failures = 0
+        latency = replies[len(replies) // 2]
+        self.recent = latency if self.recent is None else self.recent + (latency - self.recent) * 0.5
+        self.usual = latency if self.usual is None else self.usual + (latency - self.usual) * 0.05
+        degrading = self.recent > self.usual * DEGRADED_RATIO and self.recent - self.usual >= DEGRADED_MINIMUM
+        if degrading or len(replies) < len(rtts):
+            self.interval = self.base_interval / DEGRADED_SPEEDUP
+        else:
+            self.interval = self.base_interval
+
+
+def read_targets(filename=TARGETS_FILE):
+    """Reads a target file. Each line is a hostname, optionally followed by 'interval=', 'count=' and 'tags='
+    options, e.g. '10.0.0.1 interval=5 tags=core,dc1'. A '[group option=value ...]' line starts a group, whose
+    options apply to the hosts below it. '#' starts a comment.
+    """
+    targets, seen = [], set()
+    group = {'group': 'default'}
+    with open(filename, 'r') as file:
+        for number, line in enumerate(file, 1):
+            words = line.split('#')[0].replace('[', ' [ ').replace(']', ' ] ').split()
+            if len(words) == 0:
+                continue
+            is_group = words[0] == '['
+            if is_group:  # New group, its options become the defaults for following hosts.
+                words = [word for word in words[1:] if word != ']']
+                if len(words) == 0:  # Don't let the hosts below inherit the previous group's options.
+                    print('Line {} of {}: a group needs a name, the hosts below are in the default group.'
+                          .format(number, filename))
+                    group = {'group': 'default'}
+                    continue
+                name, options = words[0], {'group': words[0]}
+            else:
+                name, options = words[0], dict(group)
             try:
-                t = f.readline()
-                raw = t.strip()  # Removed newline characters from 't'
-                if t == 'Control-C\n':  # If user Control-C's, break to main loop.
-                    f.readline()
-                    break
-                elif t == "Test statistics:\n":  # If this file has already been graphed, break to main loop.
-                    break
-                elif t == '':  # If empty line, break to main loop.
-                    break
-                tr = datetime.strptime(raw, "%H:%M:%S, %d/%m/%Y")  # Datetime stamp in .log file.
-                tf = str(datetime.strftime(tr, "%Y %m %d %H %M %S")).split()  # Split up datetime into separated list.
-                run_time = datetime(*[int(j) for j in tf])  # Converts dates/times into list of integers.
-            except TypeError:  # If invalid datetime given.
+                for word in words[1:]:
+                    key, _, value = word.partition('=')
+                    if key == 'interval':
+                        options['interval'] = float(value)
+                        if not options['interval'] > 0:
+                            raise ValueError
+                    elif key == 'count':
+                        options['count'] = int(value)
+                        if options['count'] < 1:
+                            raise ValueError
+                    elif key == 'tags':
+                        options['tags'] = value.split(',')
+                    else:
+                        print('Ignoring unknown option "{}" for {}.'.format(word, name))
+            except ValueError:
+                if is_group:  # Start the group anyway, so its hosts don't inherit the previous group's options.
+                    print('Line {} of {}: "{}" is not a valid value, group {} uses the default options.'
+                          .format(number, filename, word, name))
+                    group = {'group': name}
+                else:
+                    print('Ignoring line {} of {}, "{}" is not a valid value.'.format(number, filename, word))
+                continue
+            if is_group:
+                group = options
+            elif name not in seen:
+                seen.add(name)
+                targets.append(Target(name, **options))
+    return targets
+
+
+def check_targets(filename=TARGETS_FILE, tags=()):
+    """Reads a target file and checks its hosts. Returns the responsive hostnames and their targets.
+    If any 'tags' are given, only targets with at least one of them are kept.
+    """
+    targets = read_targets(filename)
+    if len(tags) > 0:
+        targets = [target for target in targets if set(tags) & set(target.tags)]
+    hosts = check_hosts([target.hostname for target in targets])
+    responsive = set(hosts)
+    return hosts, [target for target in targets if target.hostname in responsive]
+
+
+class Scheduler:
+    """Priority queue of targets ordered by when each is next due, probing them until 'future' is reached.
+    At most 'budget' probes start per second. As probes spend most of their time waiting between echoes, enough
+    may run at once for every target to keep to its interval, or 'concurrency' if that is more.
+    """
+    def __init__(self, targets, future, concurrency=PROBE_CONCURRENCY, budget=PROBE_BUDGET):
+        self.future = future
+        self.concurrency = concurrency
+        self.budget = budget
+        self.queue = []  # Heap of (due time, order added, target).
+        self.added = 0
+        self.demand = 0  # Probes running at once on average if every target keeps to its current interval.
+        self.wake = asyncio.Event()  # Set when a target is added, in case it is due before the current first.
+        loop = asyncio.get_running_loop()
+        for n, target in enumerate(targets):  # Spread first probes evenly across each target's interval.
+            self.add(target, loop.time() + target.interval * n / len(targets))
+
+    @staticmethod
+    def _demand(target):
+        """Returns the share of a probe slot 'target' needs: how long its probes last over how often they start."""
+        return (target.count - 1 + PROBE_TIMEOUT) / target.interval  # Echoes are one second apart.
+
+    def add(self, target, due=None):
+        """Adds 'target', to be probed at loop time 'due' (default now)."""
+        self.demand += self._demand(target)
+        self._schedule(target, due)
+
+    def _schedule(self, target, due=None):
+        """Schedules the next probe of 'target' at loop time 'due' (default now)."""
+        heappush(self.queue, (asyncio.get_running_loop().time() if due is None else due, self.added, target))
+        self.added += 1
+        self.wake.set()
+
+    async def _probe(self, target):
+        """Probes a target, then schedules its next probe using its adapted interval."""
+        started = asyncio.get_running_loop().time()
+        try:
+            rtts = await test(target.hostname, target.count)
+        except Exception:  # E.g. the ping command is missing. Count the probe as timed out and keep probing.
+            metrics.count('probe_errors_total')
+            now = datetime.now()
+            rtts = [None] * target.count
+            record_samples(target.hostname, [(now + timedelta(seconds=n), rtt) for n, rtt in enumerate(rtts)])
+        self.demand -= self._demand(target)
+        target.adapt(rtts)
+        self.demand += self._demand(target)
+        self._schedule(target, started + target.interval)
+
+    async def run(self):
+        """Starts each probe as it falls due, then waits for the last ones to finish."""
+        loop = asyncio.get_running_loop()
+        running = set()
+        next_start = loop.time()  # Earliest time the probe budget allows another probe to start.
+        while True:
+            remaining = (self.future - datetime.now()).total_seconds()
+            if remaining <= 0:  # Time is up, stop starting probes.
                 break
-            line = f.readline().split()  # Sometimes there will be a newline, this skips new lines.
-            if len(line) == 0:
-                line = f.readline().split()
-            if line[0] == 'Pinging':  # If pinging.
-                while True:
-                    ping_time = 0
-                    try:
-                        t = f.readline()
-                        s = t.split()  # Split data into list.
-                        if len(s) == 6:  # Normal output of ping is 6 words long.
-                            ping_time = int(s[4].replace('<', '=').split('=')[1][:-2])
-                        elif len(s) == 4:  # But one of the log files was only 4 words.
-                            ping_time = int(s[3].replace('<', '=').split('=')[1][:-2])
-                        else:  # If not 4 or 6 words we don't know what to do.
-                            raise IndexError
-                    except IndexError:
-                        if len(t.split()) == 0:  # If newline, ping is finished.
-                            break
-                        elif len(t.split()) == 3:
-                            xt.append(run_time)
-                            try:  # Use previous ping value to put a red dot on the ping graph.
-                                yt.append(y[-1])
-                            except IndexError:  # If no pings yet recorded, add timeout dot with latency 0.
-                                yt.append(0)
-                            continue
-                    x.append(run_time)
-                    y.append(ping_time)
-                for _ in range(5):  # Skip five lines.
-                    f.readline()
-            elif line[0:2] == ['Ping', 'request']:
-                f.readline()
+            wait = remaining if len(self.queue) == 0 else min(remaining, self.queue[0][0] - loop.time())
+            if wait > 0:  # Sleep until the first target is due, or one is added.
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
                 continue
-            elif line[0:2] == ['Request', 'timed']:
-                f.readline()
+            due, _, target = heappop(self.queue)
+            metrics.observe('schedule_drift_seconds', loop.time() - due)  # How late the scheduler noticed.
+            metrics.gauge('queue_depth', len(self.queue))
+            while len(running) >= max(self.concurrency, math.ceil(self.demand)):  # Wait for a free slot.
+                await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            next_start = max(next_start, loop.time())
+            if next_start > loop.time():  # Keep within the probe budget.
+                await asyncio.sleep(next_start - loop.time())
+            next_start += 1 / self.budget
+            metrics.observe('probe_dispatch_seconds', loop.time() - due)  # Includes waiting for slot and budget.
+            probe = asyncio.ensure_future(self._probe(target))
+            running.add(probe)
+            probe.add_done_callback(running.discard)
+            metrics.gauge('probes_running', len(running))
+        await asyncio.gather(*running)
+
+
+async def trace_hop(hostname, ttl):
+    """Sends one TTL limited ping with the OS ping command. Returns the address which replied, or None."""
+    ping = await asyncio.create_subprocess_exec('ping', '-n', '1', '-i', str(ttl), '-w', str(PATH_TIMEOUT * 1000),
+                                                hostname, stdout=asyncio.subprocess.PIPE)
+    output, _ = await ping.communicate()
+    reply = HOP_PATTERN.search(output.decode(errors='replace'))
+    return reply.group(1) if reply is not None else None
+
+
+async def discover_path(hostname):
+    """Finds each device between this PC and 'hostname' by probing every hop at the same time.
+    Returns the address of each hop up to the destination, None for hops which didn't reply.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        address = (await loop.getaddrinfo(hostname, None, family=socket.AF_INET))[0][4][0]
+    except OSError:  # Hostname could not be resolved.
+        return []
+    icmp = get_prober()
+    if icmp is not None and icmp.raw:  # Send TTL limited echoes from within the script.
+        hops = await icmp.trace_async(address, PATH_MAX_HOPS, PATH_TIMEOUT)
+    else:  # Run a TTL limited OS ping for every hop at once.
+        hops = await asyncio.gather(*[trace_hop(address, ttl) for ttl in range(1, PATH_MAX_HOPS + 1)])
+    if address in hops:  # Anything past the destination is a duplicate of it.
+        hops = hops[:hops.index(address) + 1]
+    while len(hops) > 0 and hops[-1] is None:  # Drop silent hops past the last reply.
+        hops.pop()
+    return hops
+
+
+def write_path(hostname, hops, heading):
+    """Appends a discovered path to 'sysinfo.txt'."""
+    with open('sysinfo.txt', 'a') as file:
+        file.write('\n{} {} ({}):\n'.format(heading, hostname, datetime.now().strftime("%H:%M:%S, %d/%m/%Y")))
+        for ttl, hop in enumerate(hops, 1):
+            file.write('{:>3}  {}\n'.format(ttl, hop or '*'))
+
+
+def route_changed(old, new):
+    """Returns True if any hop which replied in both paths is a different address.
+    Routers often limit how many 'TTL expired' replies they send, so a silent hop doesn't count as a change.
+    """
+    return any(before is not None and after is not None and before != after for before, after in zip(old, new))
+
+
+async def watch_path(destination, hosts, future, interval, scheduler, current=None):
+    """Re-discovers the path to 'destination' every PATH_RECHECK seconds until 'future' is reached.
+    Changes from 'current', the path found before the test, or from the last path found are written to
+    'sysinfo.txt', and any new responsive hops are added to 'hosts' and the scheduler.
+    """
+    current = current or None  # An empty path gives nothing to compare against.
+    while True:
+        remaining = (future - datetime.now()).total_seconds()
+        if remaining <= 0:
+            break
+        await asyncio.sleep(min(PATH_RECHECK, remaining))
+        if datetime.now() >= future:
+            break
+        hops = await discover_path(destination)
+        if len(hops) == 0:
+            continue
+        if current is not None and route_changed(current, hops):
+            write_path(destination, hops, 'Route change to')
+            for hop in await check_hosts_async([hop for hop in hops if hop is not None and hop not in hosts]):
+                hosts.append(hop)
+                scheduler.add(Target(hop, 'path', interval))
+            current = hops
+        elif current is not None:  # Same route, remember hops which only replied this time.
+            current = [after if after is not None else before for before, after in zip_longest(current, hops)]
+        else:
+            current = hops
+
+
+async def probe_engine(hosts, future, interval, concurrency, destination=None, targets=None, hops=None):
+    """Probes every host through a Scheduler, each every 'interval' seconds unless 'targets' say otherwise.
+    If 'destination' is given, its path is watched for changes from 'hops' and new hops are probed too.
+    """
+    server = None
+    if METRICS_PORT is not None:  # Serve metrics on this PC only, failing before any probes are sent.
+        try:
+            server = await asyncio.start_server(serve_metrics, '127.0.0.1', METRICS_PORT)
+        except OSError as error:
+            exit('Metrics can\'t be served on port {}: {}'.format(METRICS_PORT, error))
+    if targets is None:
+        targets = [Target(host, interval=interval) for host in hosts]
+    scheduler = Scheduler(targets, future, concurrency)
+    tasks = [scheduler.run()]
+    if LIVE_REFRESH > 0:  # Show live results while the test runs.
+        tasks.append(dashboard(future, LIVE_REFRESH))
+    if destination is not None and PATH_RECHECK > 0:
+        tasks.append(watch_path(destination, hosts, future, interval, scheduler, hops))
+    stop = asyncio.Event()  # Set once the last probe has finished.
+    helpers = []
+    if COLLECTOR is not None:  # Stream samples to the collector.
+        helpers.append(asyncio.ensure_future(agent_sender(COLLECTOR, AGENT_NAME, stop)))
+    if METRICS_FILE is not None or server is not None:
+        helpers.append(asyncio.ensure_future(export_metrics(stop, server)))
+    metrics.gauge('hosts', len(hosts))
+    await asyncio.gather(*tasks)
+    stop.set()
+    for result in await asyncio.gather(*helpers, return_exceptions=True):
+        if isinstance(result, Exception):  # Helpers failing mustn't lose the test's results.
+            print('A background task failed during the test: {!r}'.format(result))
+
+
+def run_tests(runtime, hosts, interval=PROBE_INTERVAL, concurrency=PROBE_CONCURRENCY, destination=None,
+              targets=None, hops=None):
+    """Probes all hosts for 'runtime' minutes using the probe engine."""
+    future = datetime.now() + timedelta(minutes=runtime)  # Establish time to stop performing test.
+    try:
+        asyncio.run(probe_engine(hosts, future, interval, concurrency, destination, targets, hops))
+    finally:
+        close_writer()  # Make sure every sample is on disk before graphing.
+    compact_store()
+
+
+def collector_address(address):
+    """Splits a 'host' or 'host:port' collector address."""
+    host, _, port = address.partition(':')
+    return host, int(port or COLLECTOR_PORT)
+
+
+agent_batches = {}  # Hostname -> packed records waiting to be sent to the collector.
+
+
+async def send_batches(address, name, connection):
+    """Sends all waiting samples to the collector, connecting if needed. Samples are only dropped once the collector
+    acknowledges them. Returns the (reader, writer) connection, None if it failed.
+    """
+    batches = {hostname: bytes(batch) for hostname, batch in agent_batches.items() if len(batch) > 0}
+    if len(batches) == 0:
+        return connection
+    for hostname in batches:
+        del agent_batches[hostname][:len(batches[hostname])]
+    chunk = AGENT_BUFFER // SAMPLE_STRUCT.size * SAMPLE_STRUCT.size  # Keeps every line under the collector's limit.
+    lines = []  # (hostname, records) for each line of JSON: one per host, or per chunk of a large backlog.
+    for hostname, records in batches.items():
+        lines += [(hostname, records[n:n + chunk]) for n in range(0, len(records), chunk)]
+    acked = 0
+    try:
+        if connection is None:
+            connection = await asyncio.wait_for(asyncio.open_connection(*collector_address(address),
+                                                                        limit=AGENT_LINE_LIMIT), AGENT_TIMEOUT)
+        reader, writer = connection
+        for hostname, records in lines:
+            writer.write(json.dumps({'agent': name, 'host': hostname,
+                                     'samples': base64.b64encode(records).decode()}).encode() + b'\n')
+        await asyncio.wait_for(writer.drain(), AGENT_TIMEOUT)
+        for _ in lines:  # Wait for the collector to store each line, in the order they were sent.
+            if 'stored' not in json.loads(await asyncio.wait_for(reader.readuntil(b'\n'), AGENT_TIMEOUT)):
+                raise ValueError('Unexpected reply from the collector.')
+            acked += 1
+        return connection
+    except (OSError, EOFError, ValueError, asyncio.TimeoutError):  # Keep unacknowledged samples for the next batch.
+        unacked = {}
+        for hostname, records in lines[acked:]:
+            unacked[hostname] = unacked.get(hostname, b'') + records
+        for hostname, records in unacked.items():
+            batch = agent_batches.setdefault(hostname, bytearray())
+            batch[:0] = records
+            if len(batch) > AGENT_BUFFER:  # Drop the oldest samples, as record_samples() does.
+                del batch[:len(batch) - AGENT_BUFFER // SAMPLE_STRUCT.size * SAMPLE_STRUCT.size]
+        if connection is not None:
+            connection[1].close()
+        return None
+
+
+async def agent_sender(address, name, stop):
+    """Sends waiting samples to the collector every AGENT_BATCH seconds, and once more after 'stop' is set."""
+    connection = None
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), AGENT_BATCH)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            connection = await send_batches(address, name, connection)
+        except Exception:  # Keep probing, samples are still saved locally.
+            print_exc()
+            connection = None
+    if connection is not None:
+        connection[1].close()
+        await connection[1].wait_closed()
+
+
+collected = {}  # (agent, hostname) -> name of the collector's file for that host.
+
+
+async def handle_agent(reader, writer):
+    """Stores batches of samples sent by an agent, or answers a query for the collected statistics."""
+    try:
+        async for line in reader:
+            message = json.loads(line)
+            if 'query' in message:  # Send back statistics of every host from every agent.
+                writer.write(json.dumps(collected_stats()).encode() + b'\n')
+                await writer.drain()
                 continue
-            else:  # Else who knows what happened.
-                raise Exception('An unknown error occurred.')
+            key = (message['agent'], message['host'])
+            if key not in collected:  # File names can only hold some characters.
+                collected[key] = path.join(COLLECTOR_DIR, re.sub(r'[^\w.-]', '_', '{}_{}'.format(*key)))
+            records = base64.b64decode(message['samples'])
+            store_records(collected[key], records, '{}/{}'.format(*key))
+            writer.write(json.dumps({'stored': len(records) // SAMPLE_STRUCT.size}).encode() + b'\n')
+            await writer.drain()
+    except (ValueError, KeyError, OSError):  # Not a message from an agent, drop the connection.
+        pass
+    finally:
+        writer.close()
+
+
+def collected_stats():
+    """Returns the statistics of every host from every agent, keyed by 'agent/hostname'."""
+    with stats_lock:  # Statistics are updated by the sample writer's thread.
+        return {'{}/{}'.format(*key): host_stats[name].summary()
+                for key, name in collected.items() if name in host_stats}
+
+
+def print_collected(stats):
+    """Prints a table of collected statistics."""
+    print('{:<50}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('Agent/Host', 'Min', 'Avg', 'P95', 'Max', 'Loss'))
+    for name, host in sorted(stats.items()):
+        print('{:<50}{:>8.1f}ms{:>8.1f}ms{:>8.1f}ms{:>8.1f}ms{:>9.1f}%'
+              .format(name[:49], host['min'], host['avg'], host['p95'], host['max'], host['loss']))
+
+
+async def collector(port, future):
+    """Runs the collector until 'future' is reached, merging samples from all agents into COLLECTOR_DIR."""
+    makedirs(COLLECTOR_DIR, exist_ok=True)
+    server = await asyncio.start_server(handle_agent, port=port, limit=AGENT_LINE_LIMIT)
+    async with server:
+        while datetime.now() < future:
+            await asyncio.sleep(min(LIVE_REFRESH or AGENT_BATCH, max(0, (future - datetime.now()).total_seconds())))
+            if LIVE_REFRESH > 0:
+                page_refresh()
+                print('Collecting on port {} until {}.\n'.format(port, future.strftime("%H:%M, %d/%m")))
+                print_collected(collected_stats())
+
+
+async def query_collector(address):
+    """Asks a collector for the statistics it has collected."""
+    reader, writer = await asyncio.open_connection(*collector_address(address), limit=AGENT_LINE_LIMIT)
+    writer.write(json.dumps({'query': 'stats'}).encode() + b'\n')
+    await writer.drain()
+    stats = json.loads(await reader.readline())
+    writer.close()
+    await writer.wait_closed()
+    return stats
+
+
+@lru_cache(maxsize=64)
+def parse_date(raw):
+    """Returns midnight of a 'dd/mm/YYYY' date. Cached, as every timestamp in a day shares the same date."""
+    return datetime(int(raw[6:10]), int(raw[3:5]), int(raw[0:2]))
+
+
+def parse_timestamp(raw):
+    """Parses a 'HH:MM:SS, dd/mm/YYYY' timestamp line, returning None if the line isn't one."""
+    if len(raw) != 20 or raw[2] != ':' or raw[8] != ',':
+        return None
+    try:
+        hours, minutes, seconds = int(raw[0:2]), int(raw[3:5]), int(raw[6:8])
+        if hours > 23 or minutes > 59 or seconds > 59:  # Rejected by strptime(), which this replaces.
+            return None
+        return parse_date(raw[10:]) + timedelta(hours=hours, minutes=minutes, seconds=seconds)
+    except ValueError:  # Looked like a timestamp, but wasn't one.
+        return None
+
+
+def parse_log(lines, start=None):
+    """Generator which reads raw ping output (Windows or Linux) from 'lines', such as an open .log file.
+    Yields (datetime, RTT in ms) for each reply and (datetime, None) for each timeout.
+    Pings are timed one second apart from the most recent timestamp line, or from 'start'.
+    Lines which aren't understood are skipped.
+    """
+    run_time, n = start, 0
+    for line in lines:
+        reply = REPLY_PATTERN.search(line)
+        if reply is not None:  # Successful ping.
+            if run_time is not None:
+                yield run_time + timedelta(seconds=n), float(reply.group(1))
+                n += 1
+        elif TIMEOUT_PATTERN.search(line) is not None:  # Ping failed.
+            if run_time is not None:
+                yield run_time + timedelta(seconds=n), None
+                n += 1
+        elif line[:1].isdigit():  # Might be a timestamp written before each batch of pings.
+            timestamp = parse_timestamp(line.strip())
+            if timestamp is not None:
+                run_time, n = timestamp, 0
+        elif line.startswith('Test statistics:'):  # This file has already been graphed, no more pings.
+            break
+
+
+def convert_log(hostname):
+    """Converts a {hostname}.log file of raw ping output into a {hostname}.dat sample file."""
+    with open(hostname + '.log', 'r', errors='replace') as file:
+        write_samples(hostname, parse_log(file), mode='wb')  # Replace any existing .dat file.
+    if path.exists(hostname + STATS_EXT):  # Statistics of the replaced .dat file no longer apply.
+        remove(hostname + STATS_EXT)
+
+
+def bin_samples(samples, bins):
+    """Splits samples into 'bins' equal time buckets, reading 'samples' a chunk at a time.
+    Returns bucket times and per bucket min, mean and max latency (ms, NaN if no replies) and loss (%).
+    """
+    start, end = int(samples['time'][0]), int(samples['time'][-1]) + 1
+    rtt_min = np.full(bins, np.inf)
+    rtt_max = np.full(bins, -np.inf)
+    rtt_sum = np.zeros(bins)
+    replies = np.zeros(bins)
+    timeouts = np.zeros(bins)
+    for n in range(0, len(samples), PLOT_CHUNK):
+        chunk = samples[n:n + PLOT_CHUNK]
+        index = ((chunk['time'] - start) * bins // (end - start)).clip(0, bins - 1)
+        success = chunk['status'] == STATUS_REPLY
+        rtt = chunk['rtt'][success] / 1000
+        np.minimum.at(rtt_min, index[success], rtt)
+        np.maximum.at(rtt_max, index[success], rtt)
+        rtt_sum += np.bincount(index[success], weights=rtt, minlength=bins)
+        replies += np.bincount(index[success], minlength=bins)
+        timeouts += np.bincount(index[~success], minlength=bins)
+    with np.errstate(invalid='ignore', divide='ignore'):  # Empty buckets become NaN.
+        rtt_mean = rtt_sum / replies
+        loss = timeouts / (replies + timeouts) * 100
+    rtt_min[replies == 0] = np.nan
+    rtt_max[replies == 0] = np.nan
+    edges = np.linspace(start, end, bins + 1)
+    centres = np.zeros(bins, dtype=SAMPLE_DTYPE)
+    centres['time'] = (edges[:-1] + edges[1:]) / 2
+    return sample_times(centres), rtt_min, rtt_mean, rtt_max, loss
+
+
+def graph(hostname, envelope=None):
+    """Plots latency over time by reading {hostname}.dat file.
+    Long captures ('envelope' True, or None and more samples than PLOT_BINS) are drawn as binned envelopes.
+    """
+    if not path.exists(hostname + SAMPLE_EXT):  # Older captures only have a .log file, convert it first.
+        convert_log(hostname)
+    samples = read_samples(hostname)
+    if envelope is None:
+        envelope = len(samples) > PLOT_BINS
     # Statistics
-    successes = len(y)
-    timeouts = len(yt)
-    lat_min = min(y)
-    lat_avg = sum(y) / successes
-    lat_max = max(y)
-    pkt_loss = timeouts / (timeouts + successes) * 100
+    stats = update_stats(hostname).summary()
     # Writing text to image:
     figure = plt.figure()
     figure.suptitle(hostname, fontsize=12, fontweight='bold')
     axis = figure.add_subplot(111)
     figure.subplots_adjust(top=0.85)
-    axis.set_title('Min: {:.0f}ms, Max: {:.0f}ms, Avg: {:.0f}ms, Loss: {:.2f}%'
-                   .format(lat_min, lat_max, lat_avg, pkt_loss), fontsize=10)
+    axis.set_title('Min: {min:.0f}ms, Max: {max:.0f}ms, Avg: {avg:.0f}ms, P95: {p95:.0f}ms, Loss: {loss:.2f}%'
+                   .format(**stats), fontsize=10)
     axis.set_xlabel('Date / Time')
     axis.set_ylabel('Latency (ms)')
     # Plotting parameters here.
-    axis.plot(x, y, 'b-', label='Success')
-    axis.plot(xt, yt, 'r.', label='Timeout')
+    if envelope and len(samples) > 0:
+        times, rtt_min, rtt_mean, rtt_max, loss = bin_samples(samples, PLOT_BINS)
+        axis.fill_between(times, rtt_min, rtt_max, color='b', alpha=0.3, linewidth=0, label='Min / Max')
+        axis.plot(times, rtt_mean, 'b-', linewidth=0.5, label='Mean')
+        lossy = loss > 0  # Put a red dot on buckets with timeouts, at their mean (or 0 if nothing replied).
+        axis.plot(times[lossy], np.nan_to_num(rtt_mean[lossy]), 'r.', label='Timeout')
+    else:
+        success = samples['status'] == STATUS_REPLY
+        times = sample_times(samples)
+        # Use previous ping value to put a red dot on the ping graph, or latency 0 if no pings yet recorded.
+        previous = np.maximum.accumulate(np.where(success, np.arange(len(samples)), -1))[~success]
+        axis.plot(times[success], samples['rtt'][success] / 1000, 'b-', label='Success')
+        axis.plot(times[~success], np.where(previous >= 0, samples['rtt'][np.maximum(previous, 0)] / 1000, 0),
+                  'r.', label='Timeout')
     axis.legend()
     axis.set_ylim(ymin=0)
     # Change x-axis to datetime format.
     figure.autofmt_xdate()
     fmt = dates.DateFormatter('%d/%m %H:%M')
     axis.xaxis.set_major_formatter(fmt)
-    plt.savefig(hostname + '.png', dpi=500)
-    with open(filename, 'a') as file:  # Writes statistics to end of the .log file:
-        file.write('\nTest statistics:\n')
-        file.write('Min = {:.0f}ms\nMax = {:.0f}ms\nAvg = {:.0f}ms\nLoss = {:.2f}%'
-                   .format(lat_min, lat_max, lat_avg, pkt_loss))
+    figure.savefig(hostname + '.png', dpi=PLOT_DPI)
+    plt.close(figure)  # Free the figure, as many graphs may be drawn by the same process.
+    with open(hostname + '_stats.txt', 'w') as file:  # Writes statistics next to the .dat file:
+        file.write('Test statistics:\n')
+        file.write('Min = {min:.3f}ms\nMax = {max:.3f}ms\nAvg = {avg:.3f}ms\n'
+                   'P50 = {p50:.3f}ms\nP95 = {p95:.3f}ms\nP99 = {p99:.3f}ms\n'
+                   'Jitter = {jitter:.3f}ms\nLoss = {loss:.2f}%'.format(**stats))
 
 
-def package(hosts):
+def package(hosts, compression=PACKAGE_COMPRESSION):
     """After tests are complete, packages all relevant files together into subdirectory
     and creates a .zip archive of that directory.
+    Graphs are drawn by a pool of processes while other files are written straight into the archive.
     """
-    for hostname in hosts:  # Start by creating graph of all tested hosts.
-        graph(hostname)
-    computer_name = Popen(['hostname'], stdout=PIPE)  # Discover hostname of PC to name new directory.
-    for line in computer_name.stdout:
-        computer_name = str(line)[2:-5]  # Remove other characters, save only the hostname.
+    computer_name = socket.gethostname()  # Discover hostname of PC to name new directory.
     # Name of new directory is {computer_name}_{date}_({time}):
     dir_name = computer_name + '_' + str(datetime.now().strftime("%d%m%Y(%H.%M)"))
     file_name = dir_name + '.zip'
-    system('md ' + dir_name)  # Make new directory
-    system('move *.log ' + dir_name)  # Moves all files ending in '.log' to new directory.
-    system('xcopy *.txt ' + dir_name)  # Copies all files ending in '.txt' to new directory.
-    system('move *.png ' + dir_name)  # Moves all files ending in '.png' to new directory.
-    with ZipFile(file_name, 'w', ZIP_DEFLATED) as zf:  # Create new .zip file with same name as new directory.
-        for root, dirs, files in walk(dir_name):
-            for file in files:
-                zf.write(path.join(root, file))  # Write new directory to .zip file.
-    system('move {} {}'.format(file_name, dir_name))  # Move .zip file into new directory.
+    makedirs(dir_name, exist_ok=True)  # Make new directory
+    method, level = {'fast': (ZIP_DEFLATED, 1), 'best': (ZIP_DEFLATED, 9), 'store': (ZIP_STORED, None)}[compression]
+    moves = []  # Files to move into the new directory once archived.
+    pool = ProcessPoolExecutor(max(1, min(len(hosts), cpu_count() or 1)))  # Draws graphs alongside archiving.
+    with pool, ZipFile(path.join(dir_name, file_name), 'w', method, compresslevel=level) as zf:
+
+        def archive(file, move=True):
+            """Writes 'file' to the archive under the new directory's name."""
+            stored = ZIP_STORED if file.endswith('.png') else None  # Images are already compressed.
+            zf.write(file, path.join(dir_name, file), compress_type=stored)
+            if move:
+                moves.append(file)
+
+        started = perf_counter()
+        graphs = {pool.submit(graph, hostname): hostname for hostname in hosts}  # Start drawing every graph.
+        host_files = set()
+        for hostname in hosts:
+            host_files.update([hostname + '.log', hostname + SAMPLE_EXT, hostname + STATS_EXT,
+                               hostname + '_stats.txt', hostname + '.png'])
+        # Archive files which the graphs don't touch while they are drawn.
+        for file in sorted(set(glob('*.log') + glob('*' + SAMPLE_EXT) + glob('*' + STATS_EXT) + glob('*.png'))
+                           - host_files):
+            archive(file)
+        for file in sorted(set(glob('*.txt')) - host_files):
+            archive(file, move=False)  # Text files such as 'sysinfo.txt' are copied, not moved.
+            copyfile(file, path.join(dir_name, file))
+        for done in as_completed(graphs):  # Archive each host's files as soon as its graph is done.
+            done.result()  # Raise any error from drawing the graph.
+            hostname = graphs[done]
+            for file in [hostname + '.log', hostname + SAMPLE_EXT, hostname + STATS_EXT,
+                         hostname + '_stats.txt', hostname + '.png']:
+                if path.exists(file):
+                    archive(file)
+        metrics.observe('package_seconds', perf_counter() - started)
+    for file in moves:  # Move archived files into new directory.
+        replace(file, path.join(dir_name, file))
+    if METRICS_FILE is not None:  # Final snapshot, including packaging.
+        metrics.save(METRICS_FILE)
     page_refresh()
     print('Tests have completed successfully.\nScript will exit shortly.')
     sleep(3)
@@ -179,16 +1594,14 @@ def one(runtime, hostname):
         Popen('systeminfo | find /V /I "hotfix" | find /V "KB"', shell=True, stdout=file).wait()
         Popen(['ipconfig', '/all'], stdout=file).wait()
     print('Done!')
-    now = datetime.now()
-    future = now + timedelta(minutes=runtime)  # Establish time to stop performing test.
-    while now < future:  # Keep testing until time is up.
-        now = datetime.now()  # Updates current time for each iteration.
-        test(hostname)  # Run test() on host.
-    package(hostname)  # Package all relevant files together and exit program.
+    run_tests(runtime, [hostname])  # Run test() on host until time is up.
+    package([hostname])  # Package all relevant files together and exit program.
 
 
-def two(runtime, hosts):
-    """Performs ping test on multiple unique hosts, specified in 'hosts' list."""
+def two(runtime, hosts, targets=None):
+    """Performs ping test on multiple unique hosts, specified in 'hosts' list.
+    'targets' from a target file give each host's group, tags and interval.
+    """
     page_refresh()
     print('This script will now test the following hosts:')
     for host in hosts:  # Display which hosts are being tested.
@@ -197,17 +1610,19 @@ def two(runtime, hosts):
     with open('sysinfo.txt', 'w+') as file:  # Write system/test information to a .txt file using Windows commands:
         Popen('systeminfo | find /V /I "hotfix" | find /V "KB"', shell=True, stdout=file).wait()
         Popen(['ipconfig', '/all'], stdout=file).wait()
+    if targets is not None:  # Record how each host was probed, so results can be compared by group and tag.
+        with open('sysinfo.txt', 'a') as file:
+            file.write('\nTargets:\n{:<40}{:<20}{:>10}{:>7}  {}\n'.format('Host', 'Group', 'Interval', 'Count', 'Tags'))
+            for target in targets:
+                file.write('{:<40}{:<20}{:>9g}s{:>7}  {}\n'.format(target.hostname, target.group,
+                                                                   target.base_interval, target.count,
+                                                                   ','.join(target.tags)))
     print('Done!')
     print('\nThese tests will take around {} minutes to complete.'.format(runtime))
-    for host in hosts:  # Append traceroute of host to 'sysinfo.txt' file.
+    for host in hosts[:SYSINFO_TRACES]:  # Append traceroute of host to 'sysinfo.txt' file.
         with open('sysinfo.txt', 'a+') as file:
             Popen(['tracert', host], stdout=file).wait()
-    now = datetime.now()
-    future = now + timedelta(minutes=runtime)  # Establish time to stop performing test.
-    while now < future:  # Keep testing until time is up.
-        now = datetime.now()  # Updates current time for each iteration.
-        with Pool(len(hosts)) as tester:  # Create multiple threads to test hosts simultaneously.
-            tester.map(test, hosts)  # Perform test() on all devices in list(hosts)
+    run_tests(runtime, hosts, targets=targets)  # Perform test() on all devices in list(hosts) until time is up.
     package(hosts)  # Package all relevant files together and exit program.
 
 
@@ -216,34 +1631,24 @@ def three(runtime, hostname):
     page_refresh()
     print('Testing each device between this PC and {}'.format(hostname))
     print('Discovering hosts...')
-    trace = Popen(['tracert', '-d', hostname], stdout=PIPE)  # Performs traceroute (IP addresses only) to hostname.
-    hosts, hosts_raw = [], []  # Create host lists for pre and post check.
-    for line in trace.stdout:  # Reads output of above traceroute.
-        if str(line)[34:-6] != '':  # If line is not empty.
-            hosts_raw.append(str(line)[34:-6])  # Append hostname part of line to 'hosts' list.
-    del hosts_raw[0]  # Remove first line of traceroute from 'hosts' list.
+    hops = asyncio.run(discover_path(hostname))  # Probes every hop of the path to hostname at once.
+    hosts = check_hosts([hop for hop in hops if hop is not None])  # Check all hops simultaneously.
     print('\nDiscovered devices:')
-    with Pool(len(hosts_raw)) as checker:  # Create multiple threads to check hosts simultaneously.
-        checked = checker.map(host_check, hosts_raw)  # Check all hosts in list(hosts_raw)
-        for i in list(checked):
-            if i is not None:  # Add all responsive hosts to list(hosts)
-                print(i)  # Display which hosts are being tested.
-                hosts.append(str(i))
+    for host in hosts:
+        print(host)  # Display which hosts are being tested.
     print('Done!')
     print('\nWriting information about your system into "sysinfo.txt"...')
-    with open('sysinfo.txt', 'w+') as file:  # Write system/test information to a .txt file using Windows commands:
-        Popen(['tracert', hostname], stdout=file).wait()  # Output of traceroute to destination.
-    with open('sysinfo.txt', 'a') as file:
+    with open('sysinfo.txt', 'w+'):  # Start a new 'sysinfo.txt' file.
+        pass
+    write_path(hostname, hops, 'Path to')  # Path to destination.
+    with open('sysinfo.txt', 'a') as file:  # Write system/test information to a .txt file using Windows commands:
         Popen('systeminfo | find /V /I "hotfix" | find /V "KB"', shell=True, stdout=file).wait()  # System information.
         Popen(['ipconfig', '/all'], stdout=file).wait()  # Network card information.
     print('Done!')
-    now = datetime.now()
-    future = now + timedelta(minutes=runtime)  # Establish time to stop performing test.
+    future = datetime.now() + timedelta(minutes=runtime)  # Establish time to stop performing test.
     print('Running tests until {}'.format(future.strftime("%H:%M, %d/%m")))
-    while now < future:  # Keep testing until time is up.
-        now = datetime.now()  # Updates current time for each iteration.
-        with Pool(len(hosts)) as tester:  # Create multiple threads to test hosts simultaneously.
-            tester.map(test, hosts)  # Perform test() on all devices in list(hosts)
+    # Perform test() on all devices in list(hosts) until time is up, adding any new hops if the route changes.
+    run_tests(runtime, hosts, destination=hostname, hops=hops)
     package(hosts)  # Package all relevant files together and exit program.
 
 
@@ -256,52 +1661,68 @@ def menu(runtime):
     print('3) Ping each host in a path for the default time.')  # Run three()
     print('4) Change the default time (currently: {} minutes).'.format(runtime))  # Changes 'runtime'
     print('5) Create graph of an existing file.')  # Run graph() on specified hostname.
+    print('6) Show stored history of a host.')  # Run print_history() on specified hostname.
+    print('7) Add existing files to the stored history.')  # Run import_store() on every .dat file.
     print('0) Exit')  # Quit program.
     selection = input('\nPlease select one of the options above: ')  # User chooses an option and runs function.
     if selection == '1':
         hostname = input('\nEnter the destination address/hostname: ')
         if host_check(hostname) is not None:  # If host is active, run one() test.
             one(runtime, hostname)
-        elif host_check(hostname) is None:  # If host inactive, restart menu()
+        else:  # If host inactive, restart menu()
             print('{} is not responsive.'.format(hostname))
             reset_session(runtime)
     elif selection == '2':
-        hosts, hosts_raw = [], []
-        if not path.exists('hosts.txt'):  # Look for hosts file. If it doesn't exist user must input hosts.
-            num_hosts = int(input('Enter the number of hosts to test: '))  # How many hosts to add.
-            for n in range(num_hosts):
-                hostname = input('Enter the address/hostname of host #{}: '.format(n + 1))
-                with open('hosts.txt', 'a+') as file:  # Write user input to 'hosts.txt' file.
-                    file.write(hostname)
-                    file.write('\n')
-        with open('hosts.txt', 'r') as file:  # Read from 'hosts.txt' file and append to list(hosts)
-            for line in file.readlines():
-                hosts_raw.append(line.strip())
-                with Pool(len(hosts_raw)) as checker:  # Create multiple threads to check hosts simultaneously.
-                    checked = checker.map(host_check, hosts_raw)  # Check all hosts in list(hosts_raw)
-                    for i in list(checked):
-                        if i is not None:  # Add all responsive hosts to lst(hosts)
-                            hosts.append(str(i))
-        two(runtime, hosts)  # Perform two() test on all in list(hosts)
+        targets = None
+        if path.exists(TARGETS_FILE):  # Target file gives groups and per host intervals.
+            tags = input('Only test targets with these tags, separated by commas (leave blank for all): ')
+            hosts, targets = check_targets(tags=[tag.strip() for tag in tags.split(',') if tag.strip()])
+        else:
+            if not path.exists('hosts.txt'):  # Look for hosts file. If it doesn't exist user must input hosts.
+                num_hosts = int(input('Enter the number of hosts to test: '))  # How many hosts to add.
+                for n in range(num_hosts):
+                    hostname = input('Enter the address/hostname of host #{}: '.format(n + 1))
+                    with open('hosts.txt', 'a+') as file:  # Write user input to 'hosts.txt' file.
+                        file.write(hostname)
+                        file.write('\n')
+            with open('hosts.txt', 'r') as file:  # Read from 'hosts.txt' file.
+                hosts_raw = [line.strip() for line in file]
+            hosts = check_hosts(hosts_raw)  # Check all hosts simultaneously, keeping those which respond.
+        two(runtime, hosts, targets)  # Perform two() test on all in list(hosts)
     elif selection == '3':
         hostname = input('\nPlease enter the destination address/hostname: ')  # User enters endpoint destination.
         print('Checking endpoint host...')
         if host_check(hostname) is not None:  # If endpoint is active, run three()
             three(runtime, hostname)
-        elif host_check(hostname) is None:  # If endpoint is inactive, restart menu()
+        else:  # If endpoint is inactive, restart menu()
             print('{} is not responsive.'.format(hostname))
             reset_session(runtime)
     elif selection == '4':
         mod_runtime = int(input('Enter the time (in minutes) to run each test: '))  # User enters minutes to run test.
         menu(mod_runtime)  # Restart menu() with new runtime.
     elif selection == '5':
-        filename = input('Please enter the filename (ends in ".log": ').strip()
+        filename = input('Please enter the filename (ends in ".log" or ".dat"): ').strip()
         if path.exists(filename):
             hostname = filename[:-4]
             graph(hostname)
         elif not path.exists(filename):
             print('That file is not present in the current directory.\nResetting session.')
             reset_session(runtime)
+    elif selection == '6':
+        hostname = input('Please enter the address/hostname: ').strip()
+        try:
+            start = datetime.strptime(input('From (HH:MM dd/mm/YYYY): ').strip(), "%H:%M %d/%m/%Y")
+            end = datetime.strptime(input('To (HH:MM dd/mm/YYYY): ').strip(), "%H:%M %d/%m/%Y")
+        except ValueError:
+            print('Times must be entered as HH:MM dd/mm/YYYY.')
+            reset_session(runtime)
+        print_history(hostname, start, end)
+        input('\nPress Enter to return to the menu.')
+        menu(runtime)
+    elif selection == '7':
+        import_store(sorted(glob('*' + SAMPLE_EXT)))
+        input('\nPress Enter to return to the menu.')
+        menu(runtime)
     elif selection == '0':
         page_refresh()  # Clear the screen.
         exit()  # Quit program.
@@ -314,6 +1735,7 @@ def main():
     """Determines how script will be run. Either menu mode, or command line argument mode.
     Also deals with command line argument conditions.
     """
+    global COLLECTOR  # Set when running as an agent.
     if len(argv) == 1:  # No arguments parsed to program, run menu() with default time of 15 mins.
         menu(15)
     elif len(argv) > 1:  # Arguments have been parsed, save variables and pass to functions.
@@ -323,31 +1745,23 @@ def main():
             hostname = argv[3]  # Third argument onwards is hostnames.
             if host_check(hostname) is not None:  # If host is active, run one()
                 one(runtime, hostname)
-            elif host_check(hostname) is None:  # If host inactive, say that then exit program.
+            else:  # If host inactive, say that then exit program.
                 print('{} is not responsive.'.format(hostname))
                 sleep(1)
                 exit()
         elif test_run == '2':
-            hosts = []
-            if not path.exists('hosts.txt'):  # Reads arguments if 'hosts.txt' file is not present.
-                hosts_raw = argv[3:]
-                with Pool(len(hosts_raw)) as checker:  # Create multiple threads to check hosts simultaneously.
-                    checked = checker.map(host_check, hosts_raw)  # Check all hosts in list(hosts_raw)
-                    for i in list(checked):
-                        if i is not None:  # Add all responsive hosts to lst(hosts)
-                            hosts.append(str(i))
-            elif path.exists('hosts.txt'):  # Reads hosts from 'hosts.txt' file, ignoring host arguments.
-                hosts_raw = []
-                with open('hosts.txt', 'r') as file:
-                    for line in file.readlines():
-                        hosts_raw.append(line.strip())
-                with Pool(len(hosts_raw)) as checker:  # Create multiple threads to check hosts simultaneously.
-                    checked = checker.map(host_check, hosts_raw)
-                    for i in list(checked):
-                        if i is not None:
-                            hosts.append(str(i))
+            targets = None
+            if path.exists(TARGETS_FILE):  # Reads hosts from target file, any arguments are tags to test.
+                hosts, targets = check_targets(tags=argv[3:])
+            else:
+                if not path.exists('hosts.txt'):  # Reads arguments if 'hosts.txt' file is not present.
+                    hosts_raw = argv[3:]
+                else:  # Reads hosts from 'hosts.txt' file, ignoring host arguments.
+                    with open('hosts.txt', 'r') as file:
+                        hosts_raw = [line.strip() for line in file]
+                hosts = check_hosts(hosts_raw)  # Check all hosts simultaneously, keeping those which respond.
             if len(hosts) > 0:  # If at least one host is active, run two()
-                two(runtime, hosts)
+                two(runtime, hosts, targets)
             elif len(hosts) == 0:  # If no hosts were active, quit program.
                 print('The hosts provided did not respond.')
                 sleep(1)
@@ -357,7 +1771,7 @@ def main():
             print('Checking endpoint host...')
             if host_check(hostname) is not None:  # If endpoint is active, run three()
                 three(runtime, hostname)
-            elif host_check(hostname) is None:  # If endpoint is inactive, quit program.
+            else:  # If endpoint is inactive, quit program.
                 print('{} is not responsive.'.format(hostname))
                 sleep(1)
                 exit()
@@ -370,6 +1784,39 @@ def main():
             elif not path.exists(filename):  # If file is not present, print that then quit.
                 print('File not present.')
                 exit()
+        elif test_run == '6':  # Collector: gather samples from agents on other PCs.
+            port = int(argv[3]) if len(argv) > 3 else COLLECTOR_PORT  # Optional third argument is port.
+            asyncio.run(collector(port, datetime.now() + timedelta(minutes=runtime)))
+            close_writer()
+            compact_store()
+            print_collected(collected_stats())
+        elif test_run == '7':  # Agent: test multiple hosts, also streaming samples to a collector.
+            COLLECTOR = argv[3]  # Third argument is collector address, then hostnames.
+            targets = None
+            if path.exists(TARGETS_FILE):  # Reads hosts from target file, any arguments are tags to test.
+                hosts, targets = check_targets(tags=argv[4:])
+            else:
+                if not path.exists('hosts.txt'):  # Reads arguments if 'hosts.txt' file is not present.
+                    hosts_raw = argv[4:]
+                else:  # Reads hosts from 'hosts.txt' file, ignoring host arguments.
+                    with open('hosts.txt', 'r') as file:
+                        hosts_raw = [line.strip() for line in file]
+                hosts = check_hosts(hosts_raw)
+            if len(hosts) > 0:
+                two(runtime, hosts, targets)
+            else:  # If no hosts were active, quit program.
+                print('The hosts provided did not respond.')
+                sleep(1)
+                exit()
+        elif test_run == '8':  # Print statistics collected by a collector.
+            print_collected(asyncio.run(query_collector(argv[3])))  # Third argument is collector address.
+        elif test_run == '9':  # Print stored history of a host over the last 'runtime' minutes, or a given range.
+            hostname = argv[3]  # Third argument is hostname, then optional 'HH:MM dd/mm/YYYY' start and end.
+            end = datetime.strptime(argv[5], "%H:%M %d/%m/%Y") if len(argv) > 5 else datetime.now()
+            start = datetime.strptime(argv[4], "%H:%M %d/%m/%Y") if len(argv) > 4 else end - timedelta(minutes=runtime)
+            print_history(hostname, start, end)
+        elif test_run == '10':  # Add existing .dat files to the history store, all of them if none are given.
+            import_store(argv[3:] or sorted(glob('*' + SAMPLE_EXT)))
         else:  # If user entered invalid option, tell them that, then quit.
             page_refresh()
             print('Invalid argument encountered!\nQuitting program..')
@@ -377,4 +1824,15 @@ def main():
             exit()
 
 
-main()
+if __name__ == '__main__':
+    freeze_support()  # Allows package()'s graph processes to start from the packaged .exe.
+    if PROFILE_FILE is not None:  # Profile the whole run, saving statistics even when the script exits early.
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            main()
+        finally:
+            profiler.disable()
+            profiler.dump_stats(PROFILE_FILE)
+    else:
+        main()
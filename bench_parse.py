@@ -0,0 +1,100 @@
+"""Benchmarks parse_log() throughput against synthetic Windows and Linux ping logs.
+
+Usage: python bench_parse.py [number of lines, default 2000000]
+Results are printed and appended to 'bench_output.txt' so throughput can be compared between releases.
+"""
+from datetime import datetime, timedelta
+from os import path, remove
+from subprocess import Popen, PIPE
+from tempfile import mkdtemp
+from time import perf_counter
+from sys import argv
+from PingScript import parse_log
+
+WINDOWS_BATCH = ['',
+                 '{stamp}',
+                 '',
+                 'Pinging 10.0.0.1 with 32 bytes of data:',
+                 'Reply from 10.0.0.1: bytes=32 time=12ms TTL=57',
+                 'Reply from 10.0.0.1: bytes=32 time<1ms TTL=57',
+                 'Request timed out.',
+                 'Reply from 10.0.0.1: bytes=32 time=14ms TTL=57',
+                 'Reply from 10.0.0.1: Destination host unreachable.',
+                 'Reply from 10.0.0.1: bytes=32 time=13ms TTL=57',
+                 'Reply from 10.0.0.1: bytes=32 time=12ms TTL=57',
+                 'Reply from 10.0.0.1: bytes=32 time=15ms TTL=57',
+                 'Reply from 10.0.0.1: bytes=32 time=12ms TTL=57',
+                 'Reply from 10.0.0.1: bytes=32 time=11ms TTL=57',
+                 '',
+                 'Ping statistics for 10.0.0.1:',
+                 '    Packets: Sent = 10, Received = 8, Lost = 2 (20% loss),',
+                 'Approximate round trip times in milli-seconds:',
+                 '    Minimum = 0ms, Maximum = 15ms, Average = 11ms']
+
+LINUX_BATCH = ['',
+               '{stamp}',
+               'PING 10.0.0.1 (10.0.0.1) 56(84) bytes of data.',
+               '64 bytes from 10.0.0.1: icmp_seq=1 ttl=57 time=12.1 ms',
+               '64 bytes from 10.0.0.1: icmp_seq=2 ttl=57 time=0.412 ms',
+               'no answer yet for icmp_seq=3',
+               '64 bytes from 10.0.0.1: icmp_seq=4 ttl=57 time=14.0 ms',
+               'From 10.0.0.254 icmp_seq=5 Destination Host Unreachable',
+               '64 bytes from 10.0.0.1: icmp_seq=6 ttl=57 time=13.3 ms',
+               '64 bytes from 10.0.0.1: icmp_seq=7 ttl=57 time=12.9 ms',
+               '64 bytes from 10.0.0.1: icmp_seq=8 ttl=57 time=15.2 ms',
+               '64 bytes from 10.0.0.1: icmp_seq=9 ttl=57 time=12.0 ms',
+               '64 bytes from 10.0.0.1: icmp_seq=10 ttl=57 time=11.7 ms',
+               '',
+               '--- 10.0.0.1 ping statistics ---',
+               '10 packets transmitted, 8 received, 20% packet loss, time 9012ms',
+               'rtt min/avg/max/mdev = 0.412/11.452/15.200/4.411 ms']
+
+
+def make_log(filename, batch, lines):
+    """Writes a synthetic log of at least 'lines' lines by repeating 'batch' with increasing timestamps."""
+    when = datetime(2020, 1, 1)
+    written = 0
+    with open(filename, 'w') as file:
+        while written < lines:
+            file.write('\n'.join(batch).format(stamp=when.strftime("%H:%M:%S, %d/%m/%Y")) + '\n')
+            when += timedelta(seconds=12)
+            written += len(batch)
+    return written
+
+
+def release():
+    """Returns the current git tag/commit, so results can be matched to a release."""
+    try:
+        describe = Popen(['git', 'describe', '--tags', '--always'], stdout=PIPE, stderr=PIPE)
+        return describe.communicate()[0].decode().strip() or 'unknown'
+    except OSError:  # git is not installed.
+        return 'unknown'
+
+
+def bench(name, batch, lines, directory):
+    """Times a single pass of parse_log() over a synthetic log, returning a result line."""
+    filename = path.join(directory, name + '.log')
+    written = make_log(filename, batch, lines)
+    started = perf_counter()
+    with open(filename, 'r') as file:
+        samples = sum(1 for _ in parse_log(file))
+    elapsed = perf_counter() - started
+    remove(filename)
+    return '{:<8} {:>10} lines {:>10} samples {:>8.2f}s {:>12,.0f} lines/s'.format(
+        name, written, samples, elapsed, written / elapsed)
+
+
+def main():
+    lines = int(argv[1]) if len(argv) > 1 else 2000000
+    directory = mkdtemp()
+    results = [bench('windows', WINDOWS_BATCH, lines, directory),
+               bench('linux', LINUX_BATCH, lines, directory)]
+    with open('bench_output.txt', 'a') as file:
+        file.write('{} {}\n'.format(datetime.now().strftime("%d/%m/%Y %H:%M"), release()))
+        for result in results:
+            print(result)
+            file.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
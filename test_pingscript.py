@@ -0,0 +1,479 @@
+"""Tests of PingScript which run entirely on this machine, against localhost.
+
+Usage: python -m unittest test_pingscript
+"""
+import asyncio
+import socket
+import unittest
+from datetime import datetime, timedelta
+from os import chdir, getcwd, makedirs, path
+from tempfile import mkdtemp
+from unittest.mock import patch
+import numpy as np
+import PingScript
+
+
+def samples(rtts, start=None):
+    """Returns (datetime, RTT) samples one second apart, starting at 'start'."""
+    start = start or datetime(2020, 1, 1)
+    return [(start + timedelta(seconds=n), rtt) for n, rtt in enumerate(rtts)]
+
+
+class ScriptTestCase(unittest.TestCase):
+    """Runs each test in an empty directory, with the script's shared state reset."""
+    def setUp(self):
+        self.cwd = getcwd()
+        chdir(mkdtemp())
+        PingScript.STORE_FILE = None
+        PingScript.host_stats.clear()
+        PingScript.live_windows.clear()
+        PingScript.agent_batches.clear()
+        PingScript.collected.clear()
+
+    def tearDown(self):
+        PingScript.close_writer()
+        chdir(self.cwd)
+
+
+class TestIcmpProber(unittest.TestCase):
+    def setUp(self):
+        try:
+            self.prober = PingScript.IcmpProber()
+        except OSError:
+            self.skipTest('No ICMP socket can be opened by this user.')
+
+    def tearDown(self):
+        self.prober.close()
+
+    def test_ping_localhost(self):
+        address, rtts = self.prober.ping('localhost', count=3, interval=0.1)
+        self.assertEqual(address, '127.0.0.1')
+        self.assertTrue(all(rtt is not None and rtt >= 0 for rtt in rtts))
+
+    def test_callback_error(self):
+        """An error in one reply's callback doesn't stop later replies being received."""
+        def fail(rtt, responder):
+            raise RuntimeError('callback failed')
+        self.prober._send('127.0.0.1', fail)
+        _, rtts = self.prober.ping('127.0.0.1', count=1)
+        self.assertIsNotNone(rtts[0])
+
+    def test_ttl_restored(self):
+        default = self.prober.sock.getsockopt(socket.IPPROTO_IP, socket.IP_TTL)
+        asyncio.run(self.prober.trace_async('127.0.0.1', 2, 0.5))
+        self.assertEqual(self.prober.sock.getsockopt(socket.IPPROTO_IP, socket.IP_TTL), default)
+
+
+class TestParseLog(unittest.TestCase):
+    def test_windows(self):
+        lines = ['', '10:00:00, 01/02/2020', '', 'Pinging 10.0.0.1 with 32 bytes of data:',
+                 'Reply from 10.0.0.1: bytes=32 time=12ms TTL=57',
+                 'Reply from 10.0.0.1: bytes=32 time<1ms TTL=57',
+                 'Request timed out.',
+                 'Reply from 10.0.0.1: Destination host unreachable.',
+                 '',
+                 'Ping statistics for 10.0.0.1:',
+                 '    Packets: Sent = 4, Received = 2, Lost = 2 (50% loss),',
+                 'Approximate round trip times in milli-seconds:',
+                 '    Minimum = 0ms, Maximum = 12ms, Average = 6ms',
+                 '10:00:12, 01/02/2020',
+                 'Reply from 10.0.0.1: bytes=32 time=15ms TTL=57']
+        start = datetime(2020, 2, 1, 10)
+        self.assertEqual(list(PingScript.parse_log(lines)),
+                         [(start, 12.0), (start + timedelta(seconds=1), 1.0), (start + timedelta(seconds=2), None),
+                          (start + timedelta(seconds=3), None), (start + timedelta(seconds=12), 15.0)])
+
+    def test_linux(self):
+        lines = ['PING 10.0.0.1 (10.0.0.1) 56(84) bytes of data.',
+                 '64 bytes from 10.0.0.1: icmp_seq=1 ttl=57 time=0.412 ms',
+                 'no answer yet for icmp_seq=2',
+                 'From 10.0.0.254 icmp_seq=3 Destination Host Unreachable',
+                 '64 bytes from 10.0.0.1: icmp_seq=4 ttl=57 time=14.0 ms',
+                 '--- 10.0.0.1 ping statistics ---',
+                 '4 packets transmitted, 2 received, 50% packet loss, time 3004ms',
+                 'rtt min/avg/max/mdev = 0.412/7.206/14.000/6.794 ms']
+        start = datetime(2020, 2, 1, 10)
+        self.assertEqual([rtt for _, rtt in PingScript.parse_log(lines, start)], [0.412, None, None, 14.0])
+
+    def test_pings_before_timestamp_skipped(self):
+        """Pings can't be timed until a timestamp line or 'start' is given."""
+        lines = ['Reply from 10.0.0.1: bytes=32 time=12ms TTL=57', '10:00:00, 01/02/2020',
+                 'Reply from 10.0.0.1: bytes=32 time=13ms TTL=57']
+        self.assertEqual(list(PingScript.parse_log(lines)), [(datetime(2020, 2, 1, 10), 13.0)])
+
+    def test_stops_at_test_statistics(self):
+        """Files which have already been graphed end with a summary, which isn't read as pings."""
+        lines = ['10:00:00, 01/02/2020', 'Reply from 10.0.0.1: bytes=32 time=12ms TTL=57',
+                 'Test statistics:', 'Reply from 10.0.0.1: bytes=32 time=99ms TTL=57']
+        self.assertEqual([rtt for _, rtt in PingScript.parse_log(lines)], [12.0])
+
+    def test_unknown_lines_skipped(self):
+        lines = ['10:00:00, 01/02/2020', '12345 not a timestamp', 'Some other output', '99:99:99, 01/02/2020',
+                 'Reply from 10.0.0.1: bytes=32 time=12ms TTL=57']
+        self.assertEqual(list(PingScript.parse_log(lines)), [(datetime(2020, 2, 1, 10), 12.0)])
+
+
+class TestSampleWriter(ScriptTestCase):
+    def test_every_batch_counted(self):
+        """Statistics include the first batch written for a host, and don't count the last one twice."""
+        PingScript.store_records('host', PingScript.pack_samples('host', samples([100.0])))
+        PingScript.close_writer()
+        PingScript.store_records('host', PingScript.pack_samples('host', samples([1.0], datetime(2020, 1, 2))))
+        PingScript.close_writer()
+        for stats in (PingScript.host_stats['host'], PingScript.update_stats('host')):
+            self.assertEqual(stats.replies, 2)
+            self.assertEqual(stats.summary()['max'], 100.0)
+            self.assertEqual(stats.summary()['min'], 1.0)
+
+    def test_torn_record_cut_off(self):
+        """A record left part-written by a crash doesn't shift the samples written after it."""
+        PingScript.write_samples('host', samples([5.0]))
+        with open('host' + PingScript.SAMPLE_EXT, 'ab') as file:
+            file.write(PingScript.pack_samples('host', samples([9.0]))[:13])
+        PingScript.store_records('host', PingScript.pack_samples('host', samples([7.0], datetime(2020, 1, 2))))
+        PingScript.close_writer()
+        written = PingScript.read_samples('host')
+        self.assertEqual(written['rtt'].tolist(), [5000, 7000])
+        self.assertEqual(written['status'].tolist(), [PingScript.STATUS_REPLY] * 2)
+
+    def test_error_reported(self):
+        """An error writing one host's samples is reported without stopping the writer or other hosts."""
+        update_stats = PingScript.update_stats
+
+        def fail_first(hostname):
+            if hostname == 'first':
+                raise OSError('disk full')
+            return update_stats(hostname)
+        with patch.object(PingScript, 'update_stats', fail_first), patch.object(PingScript, 'print_exc') as report:
+            PingScript.store_records('first', PingScript.pack_samples('first', samples([1.0])))
+            PingScript.store_records('second', PingScript.pack_samples('second', samples([2.0])))
+            PingScript.close_writer()
+        report.assert_called_once()
+        self.assertEqual(PingScript.host_stats['second'].replies, 1)
+
+    def test_stopped_writer_raises(self):
+        writer = PingScript.get_writer()
+        with patch('threading.excepthook'):
+            writer.queue.put(('not a batch',))  # Stops the thread.
+            writer.thread.join()
+        with self.assertRaises(RuntimeError):
+            writer.write('host', b'', 'host')
+        with self.assertRaises(RuntimeError):
+            PingScript.close_writer()
+
+
+
+class TestHostStats(ScriptTestCase):
+    def test_unreadable_sidecar_rebuilt(self):
+        PingScript.write_samples('host', samples([5.0, None, 15.0]))
+        with open('host' + PingScript.STATS_EXT, 'w') as file:
+            file.write('{"offset": 2, "repl')  # Cut short part way through saving.
+        stats = PingScript.update_stats('host')
+        self.assertEqual((stats.offset, stats.replies, stats.timeouts), (3, 2, 1))
+        self.assertEqual(PingScript.update_stats('host').summary(), stats.summary())  # Saved again in full.
+
+
+class TestLiveWindow(unittest.TestCase):
+    def records(self, rtts):
+        return np.frombuffer(PingScript.pack_samples('host', samples(rtts)), dtype=PingScript.SAMPLE_DTYPE)
+
+    def test_wrap_around(self):
+        window = PingScript.LiveWindow(4)
+        window.add(self.records([1.0, 2.0, 3.0]))
+        window.add(self.records([None, 5.0, 6.0]))  # Wraps, overwriting 1.0 and 2.0.
+        live = window.summary()
+        self.assertEqual(window.count, 4)
+        self.assertEqual((live['last'], live['min'], live['max'], live['loss']), (6.0, 3.0, 6.0, 25.0))
+        window.add(self.records([None, 7.0]))  # Ends on the last slot of the array.
+        live = window.summary()
+        self.assertEqual(window.next, 0)
+        self.assertEqual((live['last'], live['min'], live['max'], live['loss']), (7.0, 5.0, 7.0, 25.0))
+
+    def test_overfilled(self):
+        """Adding more records than the window holds keeps only the newest."""
+        window = PingScript.LiveWindow(4)
+        window.add(self.records([1.0]))
+        window.add(self.records([None, None, 10.0, 20.0, 30.0, 40.0]))
+        live = window.summary()
+        self.assertEqual(window.count, 4)
+        self.assertEqual((live['last'], live['min'], live['max'], live['loss']), (40.0, 10.0, 40.0, 0.0))
+
+
+class TestCollector(ScriptTestCase):
+    def setUp(self):
+        super().setUp()
+        makedirs(PingScript.COLLECTOR_DIR)
+
+    def queue(self, hostname, rtts):
+        """Queues samples for the collector, as the probe loop of an agent does."""
+        PingScript.agent_batches.setdefault(hostname, bytearray()).extend(
+            PingScript.pack_samples(hostname, samples(rtts)))
+
+    def collect(self, *agents):
+        """Starts a collector on localhost and sends it batches from each (agent name, [(hostname, rtts)]) in turn.
+        Returns the collected statistics.
+        """
+        async def run():
+            server = await asyncio.start_server(PingScript.handle_agent, '127.0.0.1', 0,
+                                                limit=PingScript.AGENT_LINE_LIMIT)
+            address = '127.0.0.1:{}'.format(server.sockets[0].getsockname()[1])
+            async with server:
+                for name, hosts in agents:
+                    for hostname, rtts in hosts:
+                        self.queue(hostname, rtts)
+                    connection = await PingScript.send_batches(address, name, connection=None)
+                    self.assertIsNotNone(connection)
+                    connection[1].close()
+                    await connection[1].wait_closed()
+        asyncio.run(run())
+        PingScript.close_writer()
+        return PingScript.collected_stats()
+
+    def test_multiple_agents(self):
+        stats = self.collect(('a1', [('localhost', [5.0, 7.0]), ('gateway', [1.0, None])]),
+                             ('a2', [('localhost', [20.0])]))
+        self.assertEqual(sorted(stats), ['a1/gateway', 'a1/localhost', 'a2/localhost'])
+        self.assertEqual((stats['a1/localhost']['min'], stats['a1/localhost']['max']), (5.0, 7.0))
+        self.assertEqual(stats['a1/gateway']['loss'], 50.0)
+        self.assertEqual(stats['a2/localhost']['max'], 20.0)
+
+    def test_large_backlog(self):
+        """A backlog larger than the default stream limit arrives in full, along with other hosts' samples."""
+        count = PingScript.AGENT_BUFFER // PingScript.SAMPLE_STRUCT.size
+        stats = self.collect(('a1', [('busy', [float(n % 50 + 1) for n in range(count)]), ('quiet', [3.0])]))
+        self.assertEqual(PingScript.host_stats[PingScript.collected[('a1', 'busy')]].replies, count)
+        self.assertEqual(stats['a1/quiet']['max'], 3.0)
+        self.assertEqual(sum(len(batch) for batch in PingScript.agent_batches.values()), 0)
+
+    def send_to(self, handler):
+        """Sends waiting samples to a collector on localhost which answers with 'handler'. Returns the connection."""
+        async def run():
+            server = await asyncio.start_server(handler, '127.0.0.1', 0)
+            async with server:
+                return await PingScript.send_batches('127.0.0.1:{}'.format(server.sockets[0].getsockname()[1]),
+                                                     'a1', None)
+        with patch.object(PingScript, 'AGENT_TIMEOUT', 0.2):
+            return asyncio.run(run())
+
+    def test_collector_stalled(self):
+        """A collector which never acknowledges samples doesn't hold up the agent, and the samples are kept."""
+        async def stall(reader, writer):
+            await reader.readline()
+            await asyncio.sleep(1)
+            writer.close()
+        self.queue('localhost', [5.0, 6.0])
+        self.assertIsNone(self.send_to(stall))
+        self.assertEqual(len(PingScript.agent_batches['localhost']), 2 * PingScript.SAMPLE_STRUCT.size)
+
+    def test_partly_acknowledged(self):
+        """Only samples the collector didn't acknowledge are sent again."""
+        async def ack_first(reader, writer):
+            await reader.readline()
+            writer.write(b'{"stored": 1}\n')
+            await writer.drain()
+            writer.close()
+        self.queue('first', [5.0])
+        self.queue('second', [6.0, 7.0])
+        self.assertIsNone(self.send_to(ack_first))
+        self.assertEqual(len(PingScript.agent_batches['first']), 0)
+        self.assertEqual(len(PingScript.agent_batches['second']), 2 * PingScript.SAMPLE_STRUCT.size)
+
+    def test_collector_unreachable(self):
+        """Samples are kept until a collector has stored them."""
+        self.queue('localhost', [5.0, 6.0])
+        with socket.socket() as unused:  # Find a port nothing is listening on.
+            unused.bind(('127.0.0.1', 0))
+            port = unused.getsockname()[1]
+        self.assertIsNone(asyncio.run(PingScript.send_batches('127.0.0.1:{}'.format(port), 'a1', None)))
+        self.assertEqual(len(PingScript.agent_batches['localhost']), 2 * PingScript.SAMPLE_STRUCT.size)
+
+
+class TestTarget(unittest.TestCase):
+    def test_jitter_on_fast_link(self):
+        """Small changes in latency on a fast link don't count as degrading."""
+        target = PingScript.Target('gateway', interval=1)
+        for rtts in ([0.3] * 10, [0.3] * 10, [2.5] * 10, [2.9] * 10):
+            target.adapt(rtts)
+        self.assertEqual(target.interval, 1)
+
+    def test_degrading(self):
+        target = PingScript.Target('remote', interval=1)
+        for _ in range(20):
+            target.adapt([20.0] * 10)
+        target.adapt([60.0] * 10)
+        self.assertEqual(target.interval, 1 / PingScript.DEGRADED_SPEEDUP)
+
+    def test_backoff(self):
+        target = PingScript.Target('down', interval=1)
+        for _ in range(10):
+            target.adapt([None] * 10)
+        self.assertEqual(target.interval, PingScript.BACKOFF_LIMIT)
+
+
+class TestReadTargets(ScriptTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('targets.txt', 'w') as file:
+            file.write('# Comment\n[core interval=5 tags=dc1]\n10.0.0.1\n10.0.0.2 count=3 tags=dc2\n'
+                       '10.0.0.3 interval=abc\n[]\n10.0.0.4 count=0\n10.0.0.5\n[slow interval=x]\n'
+                       '10.0.0.6 colour=red\n')
+
+    def test_bad_lines_skipped(self):
+        """Bad hosts are skipped, and hosts below a bad group header don't inherit the previous group's options."""
+        with patch('builtins.print'):
+            targets = PingScript.read_targets()
+        self.assertEqual([(target.hostname, target.group, target.interval, target.count) for target in targets],
+                         [('10.0.0.1', 'core', 5, PingScript.PROBE_COUNT), ('10.0.0.2', 'core', 5, 3),
+                          ('10.0.0.5', 'default', PingScript.PROBE_INTERVAL, PingScript.PROBE_COUNT),
+                          ('10.0.0.6', 'slow', PingScript.PROBE_INTERVAL, PingScript.PROBE_COUNT)])
+        self.assertEqual(targets[0].tags, ('dc1',))
+
+    def test_tags_filter(self):
+        with patch.object(PingScript, 'check_hosts', lambda hosts: hosts), patch('builtins.print'):
+            hosts, targets = PingScript.check_targets(tags=['dc2', 'other'])
+        self.assertEqual(hosts, ['10.0.0.2'])
+        self.assertEqual([target.hostname for target in targets], ['10.0.0.2'])
+
+
+class TestScheduler(ScriptTestCase):
+    def probe_counts(self, hosts, interval, seconds, duration, **options):
+        """Runs a Scheduler for 'seconds' over 'hosts' targets with one echo each, whose probes take 'duration'.
+        Time is scaled down, so an echo timeout lasts 'duration'. Returns how often each host was probed.
+        """
+        probes = {}
+
+        async def test(hostname, count):
+            probes[hostname] = probes.get(hostname, 0) + 1
+            await asyncio.sleep(duration)
+            return [duration * 1000] * count
+
+        async def run():
+            targets = [PingScript.Target('host{}'.format(n), interval=interval, count=1) for n in range(hosts)]
+            await PingScript.Scheduler(targets, datetime.now() + timedelta(seconds=seconds), **options).run()
+        with patch.multiple(PingScript, test=test, PROBE_TIMEOUT=duration):
+            asyncio.run(run())
+        return probes
+
+    def test_many_targets_keep_interval(self):
+        """Probes waiting between echoes don't hold back other hosts, however many there are."""
+        probes = self.probe_counts(300, 0.12, 1.2, 0.095, concurrency=1, budget=100000)
+        self.assertEqual(len(probes), 300)
+        self.assertGreaterEqual(min(probes.values()), 8)  # About every 0.12 seconds.
+
+    def test_budget_limits_rate(self):
+        probes = self.probe_counts(200, 0.1, 1, 0.01, budget=100)
+        self.assertLess(abs(sum(probes.values()) - 100), 15)  # Far fewer than the 2000 the intervals ask for.
+
+    def test_probe_error(self):
+        """A probe which raises is recorded as timed out and rescheduled, without stopping the run."""
+        async def test(hostname, count):
+            raise FileNotFoundError('ping')
+
+        async def run():
+            target = PingScript.Target('missing', interval=0.1, count=2)
+            scheduler = PingScript.Scheduler([target], datetime.now() + timedelta(seconds=0.5))
+            await scheduler.run()
+            return target
+        with patch.object(PingScript, 'test', test):
+            target = asyncio.run(run())
+        PingScript.close_writer()
+        self.assertGreater(target.failures, 1)  # Probed again after the first error.
+        self.assertEqual(PingScript.host_stats['missing'].timeouts, 2 * target.failures)
+
+
+class TestProbeEngine(ScriptTestCase):
+    async def probe(self, hostname, count):
+        """Stands in for test(), recording replies without sending any pings."""
+        self.probes += 1
+        PingScript.record_samples(hostname, samples([1.0] * count, datetime.now()))
+        return [1.0] * count
+
+    def setUp(self):
+        super().setUp()
+        self.probes = 0
+
+    def test_metrics_port_in_use(self):
+        """The test stops before probing if metrics can't be served."""
+        with socket.socket() as used:
+            used.bind(('127.0.0.1', 0))
+            used.listen()
+            with patch.multiple(PingScript, test=self.probe, METRICS_PORT=used.getsockname()[1], LIVE_REFRESH=0):
+                with self.assertRaises(SystemExit):
+                    PingScript.run_tests(0.005, ['localhost'])
+        self.assertEqual(self.probes, 0)
+
+    def test_helper_error(self):
+        """A helper task failing doesn't stop the test's samples being saved."""
+        async def export_metrics(stop, server=None):
+            raise RuntimeError('export failed')
+        with patch.multiple(PingScript, test=self.probe, export_metrics=export_metrics, METRICS_FILE='metrics.prom',
+                            LIVE_REFRESH=0), patch('builtins.print'):
+            PingScript.run_tests(0.005, ['localhost'], interval=0.1)
+        self.assertGreater(self.probes, 0)
+        self.assertEqual(len(PingScript.read_samples('localhost')), self.probes * PingScript.PROBE_COUNT)
+
+
+class TestWatchPath(ScriptTestCase):
+    def watch(self, initial, *paths):
+        """Watches the path to 192.0.2.9, rechecked every 0.1 seconds, which is found to be each of 'paths' in turn.
+        Returns what was written to 'sysinfo.txt'.
+        """
+        found = iter(paths)
+
+        async def discover_path(destination):
+            return next(found, paths[-1])
+
+        async def check_hosts_async(hosts):
+            return []
+
+        async def run():
+            scheduler = PingScript.Scheduler([], datetime.now())
+            await PingScript.watch_path('192.0.2.9', [], datetime.now() + timedelta(seconds=0.1 * len(paths) + 0.05),
+                                        1, scheduler, initial)
+        with patch.multiple(PingScript, PATH_RECHECK=0.1, discover_path=discover_path,
+                            check_hosts_async=check_hosts_async):
+            asyncio.run(run())
+        if not path.exists('sysinfo.txt'):
+            return ''
+        with open('sysinfo.txt') as file:
+            return file.read()
+
+    def test_change_from_initial_path(self):
+        """A route change found at the first recheck is compared against the path found before the test."""
+        self.assertIn('Route change to 192.0.2.9', self.watch(['10.0.0.1', '10.0.0.2'], ['10.0.0.1', '192.0.2.7']))
+
+    def test_silent_hops_ignored(self):
+        """Hops which sometimes don't reply aren't route changes."""
+        route = ['10.0.0.1', '10.0.0.2', '192.0.2.9']
+        self.assertEqual(self.watch(route, ['10.0.0.1', None, '192.0.2.9'], [None, '10.0.0.2', '192.0.2.9'],
+                                    ['10.0.0.1', None], route), '')
+
+    def test_route_changed(self):
+        self.assertFalse(PingScript.route_changed(['10.0.0.1', None, '10.0.0.3'], ['10.0.0.1', '10.0.0.2']))
+        self.assertTrue(PingScript.route_changed(['10.0.0.1', '10.0.0.2'], [None, '10.0.0.5', '10.0.0.3']))
+
+
+class TestHistoryStore(ScriptTestCase):
+    def test_import_and_compact(self):
+        """Old samples imported from a .dat file are compacted into summaries with the same statistics."""
+        old = datetime.now() - timedelta(days=PingScript.STORE_RETENTION + 1)
+        PingScript.write_samples('host', samples([2.0, 4.0, None, 6.0], old.replace(second=0, microsecond=0)))
+        PingScript.write_samples('other', samples([1.0] * 50000, old))  # Enough to free many pages.
+        PingScript.STORE_FILE = 'history.db'
+        PingScript.store = None
+        try:
+            PingScript.import_store(['host' + PingScript.SAMPLE_EXT, 'other' + PingScript.SAMPLE_EXT])
+            start, end = int((old - timedelta(hours=1)).timestamp() * 1e6), int(datetime.now().timestamp() * 1e6)
+            self.assertEqual(len(PingScript.store.query('host', start, end)), 0)  # Only summaries are left.
+            self.assertEqual(PingScript.store.db.execute('PRAGMA freelist_count').fetchone()[0], 0)  # Space freed.
+            summary = PingScript.store.summary('host', start, end)
+            self.assertEqual((summary['samples'], summary['min'], summary['avg'], summary['max'], summary['loss']),
+                             (4, 2.0, 4.0, 6.0, 25.0))
+        finally:
+            PingScript.store.db.close()
+            PingScript.store = None
+            PingScript.STORE_FILE = None
+
+
+if __name__ == '__main__':
+    unittest.main()